@@ -1,4 +1,7 @@
-def find_offset_SAD(ref, target_trace, threshold):
+import numpy as np
+
+
+def find_offset_SAD_scalar(ref, target_trace, threshold):
     def calc_SAD(a1, a2):
         SAD = 0
         for v1, v2 in zip(a1, a2):
@@ -8,7 +11,28 @@ def find_offset_SAD(ref, target_trace, threshold):
         if calc_SAD(ref, target_trace[offset:offset+len(ref)]) < threshold:
             return offset
     return None
-        
+
+def calc_SAD_all(ref, target_trace, start=0, stop=None):
+    # SAD of ref against target_trace at every offset in [start, stop), all at once:
+    # a read-only (offsets, len(ref)) window view of the trace, no copies until the subtraction
+    ref = np.asarray(ref, dtype=np.float64)
+    target_trace = np.asarray(target_trace, dtype=np.float64)
+    if stop is None:
+        stop = len(target_trace) - len(ref)
+    windows = np.lib.stride_tricks.sliding_window_view(target_trace, len(ref))[start:stop]
+    return np.abs(windows - ref).sum(axis=1)
+
+def find_offset_SAD(ref, target_trace, threshold, chunk=512):
+    # same result as find_offset_SAD_scalar: the first offset with SAD < threshold.
+    # Offsets are checked chunk at a time, so a match near the start returns early
+    # and memory stays at chunk * len(ref) values
+    end = len(target_trace) - len(ref)
+    for start in range(0, end, chunk):
+        hits = np.flatnonzero(calc_SAD_all(ref, target_trace, start, min(start + chunk, end)) < threshold)
+        if len(hits):
+            return start + int(hits[0])
+    return None
+
 def guess_password_SAD(cap_pass_trace, find_offset, ref, original_offset, threshold, target):
     trylist = "abcdefghijklmnopqrstuvwxyz0123456789"
     password = ""
@@ -34,3 +58,28 @@ def guess_password_SAD(cap_pass_trace, find_offset, ref, original_offset, thresh
                 password+=c
                 print("Success, password now: ", password)
                 break
+
+def benchmark(samples=5000, ref_len=500, repeat=3):
+    # time find_offset_SAD against find_offset_SAD_scalar on random
+    # traces with ref hidden at a late offset (worst case for the early exit)
+    import time
+    rng = np.random.RandomState(0)
+    trace = rng.uniform(-0.5, 0.5, samples)
+    offset = samples - ref_len - 100
+    ref = trace[offset:offset + ref_len] + rng.normal(0, 0.001, ref_len)
+    threshold = 1.0
+    result = {}
+    for name, find_offset in (("scalar", find_offset_SAD_scalar), ("vectorized", find_offset_SAD)):
+        start = time.perf_counter()
+        for i in range(repeat):
+            found = find_offset(ref, trace, threshold)
+        result[name] = (time.perf_counter() - start) / repeat
+        if found != offset:
+            raise ValueError("%s found offset %r, expected %d" % (name, found, offset))
+    return result
+
+if __name__ == "__main__":
+    result = benchmark()
+    print("5000 sample trace, 500 sample ref:")
+    print("scalar:     %8.2f ms" % (result["scalar"] * 1e3))
+    print("vectorized: %8.2f ms (%.0fx)" % (result["vectorized"] * 1e3, result["scalar"] / result["vectorized"]))
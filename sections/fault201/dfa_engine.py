@@ -0,0 +1,272 @@
+"""Vectorized engine for the 1.5 round AES DFA equations in out2.py.
+
+``out2.Attack(Known)`` evaluates the generated equation system one byte at a
+time: every ``xN=...`` line is a scalar expression over ``S()``, ``R()`` and
+``Multiply()``, and every nested ``if`` is a consistency check. This module
+compiles the same function (read from out2.py, so the two can't get out of
+sync) into one that works on NumPy uint8 arrays:
+
+* ``S(x)``/``R(x)`` become lookups into the s-box/inverse s-box arrays,
+  ``Multiply(c, x)`` a lookup into the 256x256 GF(2^8) multiplication table.
+* every ``if A == B:`` becomes ``ok &= A == B`` and its body is evaluated
+  for all entries, so no branch is ever taken per element.
+* the prints and the K_0/K_1 table at the end become one (..., 4, 4) result.
+
+Every entry of ``Known`` can be a scalar or an array, and they are broadcast
+against each other. Known values that are not known can then be enumerated
+over a grid, e.g. for two unknown bytes::
+
+    Known[5] = np.arange(256)[:, None]
+    Known[6] = np.arange(256)[None, :]
+    ok, K_0 = attack(Known) # ok has shape (256, 256)
+    candidates = K_0[ok]
+
+``solve_batch`` does the same for a whole campaign: an (M, 49) array of
+Known vectors, one per faulty ciphertext, is evaluated in chunks of rows and
+the candidate keys of the rows are intersected as it goes.
+"""
+import ast
+import inspect
+import sys
+
+import numpy as np
+
+import gf256
+import out2
+
+SBOX = gf256.SBOX
+RSBOX = gf256.INV_SBOX
+MUL = gf256.MUL
+
+
+def _index(node):
+    # ast.Index was removed in 3.9
+    return node if sys.version_info >= (3, 9) else ast.Index(value=node)
+
+
+class _Vectorize(ast.NodeTransformer):
+    """S(x) -> _S[x], R(x) -> _R[x], Multiply(c, x) -> _M[c][x]."""
+    _tables = {'S': '_S', 'R': '_R'}
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        name = getattr(node.func, 'id', None)
+        if name in self._tables:
+            return ast.Subscript(value=ast.Name(id=self._tables[name], ctx=ast.Load()),
+                                 slice=_index(node.args[0]), ctx=ast.Load())
+        if name == 'Multiply':
+            row = ast.Subscript(value=ast.Name(id='_M', ctx=ast.Load()), slice=_index(node.args[0]), ctx=ast.Load())
+            return ast.Subscript(value=row, slice=_index(node.args[1]), ctx=ast.Load())
+        return node
+
+
+def _flatten(body, out, keys):
+    """Turn the nested ifs of Attack into a flat list of statements."""
+    for stmt in body:
+        if isinstance(stmt, ast.If):
+            check = ast.parse("_ok = _ok & (0 == 0)").body[0]
+            check.value.right.left = stmt.test.left
+            check.value.right.comparators = stmt.test.comparators
+            out.append(check)
+            _flatten(stmt.body, out, keys)
+        elif isinstance(stmt, ast.Assign):
+            target = stmt.targets[0]
+            if isinstance(target, ast.Name) and target.id not in keys:
+                out.append(stmt)
+            elif isinstance(target, ast.Subscript):
+                # K_0[i][j] = xN
+                i = ast.literal_eval(target.value.slice if sys.version_info >= (3, 9) else target.value.slice.value)
+                j = ast.literal_eval(target.slice if sys.version_info >= (3, 9) else target.slice.value)
+                keys[target.value.value.id][i * 4 + j] = stmt.value.id
+        # prints and the return are dropped
+
+
+def _compile(func):
+    tree = ast.parse(inspect.getsource(func))
+    body = []
+    keys = {'K_0': [None] * 16, 'K_1': [None] * 16}
+    _flatten(tree.body[0].body, body, keys)
+    template = ast.parse("def _attack(Known, _S, _R, _M):\n    _ok = True\n    return _ok, [{}], [{}]".format(
+        ", ".join(keys['K_0']), ", ".join(keys['K_1'])))
+    func_def = template.body[0]
+    func_def.body[1:1] = [_Vectorize().visit(stmt) for stmt in body]
+    ast.fix_missing_locations(template)
+    namespace = {}
+    exec(compile(template, inspect.getsourcefile(func), 'exec'), namespace)
+    return namespace['_attack']
+
+
+_attack = _compile(out2.Attack)
+
+
+def attack(Known, with_K_1=False):
+    """Vectorized ``out2.Attack``.
+
+    Args:
+        Known (list): The 49 known values, as for ``out2.Attack``. Each entry
+            can be an int or an array, all entries are broadcast together.
+        with_K_1 (bool): Also return the recovered K_1.
+
+    Returns:
+        (ok, K_0) or (ok, K_0, K_1): ok is a bool array of the broadcast shape,
+        True where all the checks of Attack pass. K_0 and K_1 have the
+        broadcast shape + (4, 4), and are only meaningful where ok is True.
+    """
+    known = [np.asarray(k, dtype=np.uint8) for k in Known]
+    shape = np.broadcast(*known).shape
+    ok, k0, k1 = _attack(known, SBOX, RSBOX, MUL)
+
+    def table(values):
+        return np.stack([np.broadcast_to(v, shape) for v in values], axis=-1).reshape(shape + (4, 4))
+
+    ok = np.broadcast_to(ok, shape)
+    if with_K_1:
+        return ok, table(k0), table(k1)
+    return ok, table(k0)
+
+
+def candidates(Known):
+    """Returns the distinct K_0 (as an (n, 4, 4) array) consistent with Known."""
+    ok, K_0 = attack(Known)
+    return np.unique(K_0[ok].reshape(-1, 16), axis=0).reshape(-1, 4, 4)
+
+
+def _intersect(a, b):
+    # rows of (n, 16) uint8 array a that are also in b
+    both, counts = np.unique(np.concatenate([np.unique(a, axis=0), np.unique(b, axis=0)]),
+                             axis=0, return_counts=True)
+    return both[counts == 2]
+
+
+def narrow(known, unknown=(), chunk=None):
+    """Evaluates many Known vectors and yields the candidate keys after every chunk.
+
+    Each row's candidate set is the K_0 of every value of the unknown columns
+    that passes the checks (at most one K_0 if there are no unknowns). Rows
+    without any candidate (ineffective faults, bad captures) are skipped; the
+    candidate sets of the other rows are intersected.
+
+    Args:
+        known: (M, 49) array of Known vectors.
+        unknown (list): Columns of known that aren't known, enumerated over
+            all 256**len(unknown) values for every row.
+        chunk (int): Rows evaluated per call to attack(). By default about
+            65536 hypotheses per call.
+
+    Yields:
+        (candidates, solved): the (n, 4, 4) K_0 consistent with every row
+        solved so far (None before the first solved row), and the number of
+        rows evaluated so far that had a candidate.
+    """
+    known = np.asarray(known, dtype=np.uint8)
+    unknown = list(unknown)
+    grid = np.ix_(*[np.arange(256, dtype=np.uint8)] * len(unknown)) if unknown else ()
+    chunk = chunk or max(1, 65536 // 256 ** len(unknown))
+    keys, solved = None, 0
+    for start in range(0, len(known), chunk):
+        rows = known[start:start + chunk]
+        columns = [rows[:, i].reshape((-1,) + (1,) * len(unknown)) for i in range(49)]
+        for i, values in zip(unknown, grid):
+            columns[i] = values[np.newaxis]
+        ok, K_0 = attack(columns)
+        ok = ok.reshape(len(rows), -1)
+        row = np.nonzero(ok)[0]
+        if len(row):
+            # distinct (row, key) pairs, then the keys found in every solved row
+            pairs = np.unique(np.column_stack([row, K_0.reshape(len(rows), -1, 16)[ok]]), axis=0)
+            found, counts = np.unique(pairs[:, 1:].astype(np.uint8), axis=0, return_counts=True)
+            n = len(np.unique(row))
+            found = found[counts == n]
+            keys = found if keys is None else _intersect(keys, found)
+            solved += n
+        yield (None if keys is None else keys.reshape(-1, 4, 4)), solved
+
+
+def solve_batch(known, unknown=(), chunk=None):
+    """Intersects the candidate keys of all rows of an (M, 49) Known array.
+
+    See narrow() for the arguments.
+
+    Returns:
+        (candidates, solved): the (n, 4, 4) K_0 consistent with every row
+        that has a candidate (empty if no row has one), and how many rows did.
+    """
+    candidates, solved = np.zeros((0, 4, 4), dtype=np.uint8), 0
+    for keys, solved in narrow(known, unknown, chunk):
+        if keys is not None:
+            candidates = keys
+    return candidates, solved
+
+
+def _scalar_attack(Known):
+    import contextlib
+    import io
+    with contextlib.redirect_stdout(io.StringIO()):
+        return out2.Attack(Known)
+
+
+def self_test(n=200, seed=0):
+    """Checks attack() against out2.Attack on n generated and n corrupted Known vectors.
+
+    The vectors are checked both one at a time and as a single batch (every
+    entry of Known an (n,) array). Raises AssertionError on any mismatch.
+    """
+    import random
+    random.seed(seed)
+    out2.MakeTableMul2_8()
+
+    vectors = []
+    for i in range(n):
+        Known = [0] * 49
+        out2.Generator(Known)
+        vectors.append(Known)
+        # a random fault in one of the ciphertext bytes
+        bad = list(Known)
+        bad[random.randrange(1, 49)] ^= random.randrange(1, 256)
+        vectors.append(bad)
+
+    expected = [_scalar_attack(Known) for Known in vectors]
+    for Known, K_0 in zip(vectors, expected):
+        ok, vec = attack(Known)
+        assert bool(ok) == (K_0 is not None)
+        if K_0 is not None:
+            assert np.array_equal(vec, K_0)
+
+    ok, batch = attack(list(np.array(vectors, dtype=np.uint8).T))
+    for i, K_0 in enumerate(expected):
+        assert ok[i] == (K_0 is not None)
+        if K_0 is not None:
+            assert np.array_equal(batch[i], K_0)
+    return sum(K_0 is not None for K_0 in expected)
+
+
+if __name__ == "__main__":
+    import time
+    solved = self_test()
+    print("self test passed, {} of 400 vectors solved".format(solved))
+
+    # one unknown byte pair, 65536 hypotheses
+    Known = [0] * 49
+    out2.Generator(Known)
+    grid = list(Known)
+    grid[1] = np.arange(256)[:, None]
+    grid[2] = np.arange(256)[None, :]
+    start = time.perf_counter()
+    ok, K_0 = attack(grid)
+    seconds = time.perf_counter() - start
+    print("{} hypotheses in {:.3f}s ({:.0f}/s), {} left".format(ok.size, seconds, ok.size / seconds, ok.sum()))
+
+    # a campaign of repeated glitches on one pair, half of them with a corrupted output byte
+    M = 1000
+    Known = [0] * 49
+    out2.Generator(Known)
+    rows = np.tile(np.array(Known, dtype=np.uint8), (M, 1))
+    rows[np.arange(1, M, 2), np.random.randint(1, 49, M // 2)] ^= np.random.randint(1, 256, M // 2).astype(np.uint8)
+    start = time.perf_counter()
+    keys, solved = solve_batch(rows)
+    seconds = time.perf_counter() - start
+    print("{} pairs in {:.3f}s ({:.0f}/s), {} solved, {} candidate(s)".format(M, seconds, M / seconds, solved, len(keys)))
+    start = time.perf_counter()
+    keys, solved = solve_batch(rows[:50], unknown=[7])
+    seconds = time.perf_counter() - start
+    print("50 pairs with byte 7 unknown in {:.3f}s, {} solved, {} candidate(s)".format(seconds, solved, len(keys)))
@@ -0,0 +1,168 @@
+"""Multiprocess key-candidate search over unknown bytes of the out2.py DFA equations.
+
+When some of the 49 ``Known`` values aren't known (e.g. ciphertext bytes that
+couldn't be read back, or a plaintext byte), every possible value of them is
+a hypothesis. ``KeySearch`` enumerates them with ``dfa_engine.attack``: the
+last ``inner`` unknown bytes are broadcast as a grid inside each call, the
+other ones are split across a process pool. Surviving candidates are streamed
+back as workers find them::
+
+    from dfa_search import KeySearch
+    search = KeySearch(Known, unknown=[1, 2, 3], stop_after=1)
+    for guess, K_0 in search:
+        print(guess, K_0)
+    print(search.stats)
+
+A full set of Known values determines the key, so with the right hypothesis
+one key is left and wrong ones almost never pass all the checks. Use
+``stop_after=1`` to stop as soon as the first key is found.
+"""
+import time
+
+import numpy as np
+
+import dfa_engine
+
+_worker = {}
+
+
+def _init_worker(Known, unknown, inner):
+    _worker['Known'] = list(Known)
+    _worker['unknown'] = unknown
+    _worker['inner'] = inner
+
+
+def _search_range(start, stop):
+    """Checks outer hypotheses [start, stop). Returns (count, [(guess, K_0), ...])."""
+    Known, unknown, inner = _worker['Known'], _worker['unknown'], _worker['inner']
+    outer = unknown[:len(unknown) - inner]
+    grid = np.ix_(*[np.arange(256, dtype=np.uint8)] * inner)
+    for index, values in zip(unknown[len(outer):], grid):
+        Known[index] = values
+    found = []
+    for t in range(start, stop):
+        prefix = [(t >> (8 * i)) & 0xff for i in reversed(range(len(outer)))]
+        for index, value in zip(outer, prefix):
+            Known[index] = value
+        ok, K_0 = dfa_engine.attack(Known)
+        # argwhere, unlike nonzero, also handles a 0-d ok (no inner bytes)
+        for hit in map(tuple, np.argwhere(ok)):
+            found.append((tuple(prefix) + tuple(int(v) for v in hit), K_0[hit]))
+    return (stop - start) * 256 ** inner, found
+
+
+class KeySearch(object):
+    """Searches all values of the unknown Known bytes for keys passing out2.Attack.
+
+    Args:
+        Known (list): The 49 values for ``out2.Attack``. Entries listed in
+            unknown are ignored.
+        unknown (list): Indices into Known of the unknown bytes.
+        processes (int): Size of the process pool. Defaults to the number of
+            cores, 1 runs everything in this process.
+        inner (int): Number of unknown bytes enumerated inside each call to
+            attack() (256**inner hypotheses per call). 2 uses ~10MB per worker.
+        stop_after (int): Stop once this many candidates were found. None
+            searches the whole space.
+        progress (callable): Optional, called with the number of hypotheses
+            checked after every finished task.
+    """
+    def __init__(self, Known, unknown, processes=None, inner=2, stop_after=None, progress=None):
+        import multiprocessing
+        self.Known = list(Known)
+        self.unknown = list(unknown)
+        self.inner = min(inner, len(self.unknown))
+        self.processes = processes or multiprocessing.cpu_count()
+        self.stop_after = stop_after
+        self.progress = progress
+        self.candidates = []
+        self.stats = {'hypotheses': 0, 'seconds': 0.0}
+
+    @property
+    def space(self):
+        """Total number of hypotheses."""
+        return 256 ** len(self.unknown)
+
+    def _tasks(self):
+        outer = 256 ** (len(self.unknown) - self.inner)
+        # a few tasks per worker, so the load stays balanced and results keep coming in
+        step = max(1, outer // (self.processes * 16))
+        return [(start, min(start + step, outer)) for start in range(0, outer, step)]
+
+    def _update(self, count, start):
+        self.stats['hypotheses'] += count
+        self.stats['seconds'] = time.perf_counter() - start
+        rate = self.stats['hypotheses'] / self.stats['seconds'] if self.stats['seconds'] else 0
+        self.stats['hypotheses_per_second'] = rate
+        self.stats['hypotheses_per_second_per_core'] = rate / self.processes
+        if self.progress:
+            self.progress(count)
+
+    def __iter__(self):
+        """Yields (guess, K_0) for every candidate, as they are found.
+
+        guess holds the values of the unknown bytes, in the order of unknown.
+        """
+        start = time.perf_counter()
+        self.candidates = []
+        self.stats = {'hypotheses': 0, 'seconds': 0.0}
+        tasks = self._tasks()
+        if self.processes == 1:
+            _init_worker(self.Known, self.unknown, self.inner)
+            results = (_search_range(*task) for task in tasks)
+            pool = None
+        else:
+            from multiprocessing.pool import Pool
+            pool = Pool(self.processes, _init_worker, (self.Known, self.unknown, self.inner))
+            results = pool.imap_unordered(_star_search_range, tasks)
+        try:
+            for count, found in results:
+                self._update(count, start)
+                for candidate in found:
+                    self.candidates.append(candidate)
+                    yield candidate
+                    if self.stop_after and len(self.candidates) >= self.stop_after:
+                        return
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+    def run(self):
+        """Runs the whole search. Returns the list of (guess, K_0) candidates."""
+        for candidate in self:
+            pass
+        return self.candidates
+
+
+def _star_search_range(args):
+    return _search_range(*args)
+
+
+if __name__ == "__main__":
+    import random
+    import sys
+    import out2
+
+    # hide the first n ciphertext bytes of a generated fault pair, then search for them
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    random.seed(1)
+    out2.MakeTableMul2_8()
+    Known = [0] * 49
+    out2.Generator(Known)
+    expected = out2.Attack(Known)
+    unknown = list(range(1, n + 1))
+    truth = tuple(int(Known[i]) for i in unknown)
+
+    # nothing, or no inner byte, to enumerate: attack() returns a 0-d ok
+    for check in (KeySearch(Known, [], processes=1), KeySearch(Known, unknown[:1], processes=1, inner=0)):
+        found = check.run()
+        if not any(np.array_equal(K_0, expected) for guess, K_0 in found):
+            raise ValueError("unknown={} inner={}: key not found".format(check.unknown, check.inner))
+
+    search = KeySearch(Known, unknown, stop_after=1)
+    for guess, K_0 in search:
+        print("found {} (real {}), key {}".format(guess, truth, "correct" if np.array_equal(K_0, expected) else "WRONG"))
+    print("{} of {} hypotheses in {:.2f}s: {:.0f}/s, {:.0f}/s per core on {} processes".format(
+        search.stats['hypotheses'], search.space, search.stats['seconds'],
+        search.stats['hypotheses_per_second'], search.stats['hypotheses_per_second_per_core'], search.processes))
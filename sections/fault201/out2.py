@@ -1,6 +1,7 @@
 import os, random
 import sys
 import numpy as np
+import gf256
 #include <unistd.h>
 #include "1_1-1_0.h"
 
@@ -68,22 +69,8 @@ def R(x):	return rsbox[x]
 TableMul2_8 = np.zeros([256, 256], dtype=np.uint8)
 
 def MakeTableMul2_8():
-    aa = 0
-    bb = 0
-    r = 0
-    t = 0
-    for a in range(256 ):
-        for b in range(a, 256 ):
-            aa=a
-            bb=b
-            r=0
-            while aa != 0:
-                if (aa & 1) != 0: r=r^bb
-                t=bb & 0x80
-                bb=bb<<1
-                if t != 0: bb=bb^0x1b
-                aa=aa>>1
-            TableMul2_8[a][b]=TableMul2_8[b][a]=r
+    # built with log/antilog tables in gf256, instead of multiplying bit by bit
+    TableMul2_8[:] = gf256.MUL
 
 def Multiply(a,b):	return TableMul2_8[a][b]
 
@@ -662,7 +649,6 @@ def Generator( Known):
     x59=1+(rand()%255)
     x61=1+(rand()%255)
     x63=1+(rand()%255)
-    print(x32, Multiply(0x03, S(x57)), S(x55), S(x45), Multiply(0x02, S(x35)))
     x97=x32 ^ Multiply(0x03,S(x57)) ^ S(x55) ^ S(x45) ^ Multiply(0x02,S(x35))
     x98=x32 ^ x19 ^ Multiply(0x03,S(x59)) ^ S(x49) ^ S(x47) ^ Multiply(0x02,S(x37))
     x99=1+(rand()%255)
@@ -850,6 +836,15 @@ def Generator( Known):
     Known[48]=x160 # X'_2[0,0] 
     return 1
 
+def AttackBatch(Known, unknown=()):
+    """Attack for an (M, 49) array of Known vectors, see dfa_engine.solve_batch.
+
+    Returns the (n, 4, 4) K_0 consistent with every solvable row, and the
+    number of solvable rows.
+    """
+    import dfa_engine
+    return dfa_engine.solve_batch(Known, unknown)
+
 def rand():
     return random.getrandbits(8)
 
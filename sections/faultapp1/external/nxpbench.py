@@ -0,0 +1,201 @@
+"""Benchmarks for nxpprog without an LPC part.
+
+A pseudo terminal stands in for the serial port: ``SerialDevice`` opens the
+slave side like a real port, and a thread on the master side answers.
+
+* ``benchmark()`` answers every command with a canned response, timing the
+  host side of an ISP command round trip (how nxpprog reads responses).
+* ``benchmark_programmer()`` runs ``read_block``, ``write_ram_data``,
+  ``prog_image``, ``verify_image`` and ``blank_check_all`` against the
+  simulated bootloader in ``nxpsim``, paced at a real baud rate.
+
+Run both with::
+
+    cd sections/faultapp1
+    python -m external.nxpbench
+
+Only works where ``pty`` does (Linux, macOS), use
+``ISPSimulator.serve_socket`` elsewhere.
+"""
+import os
+import pty
+import threading
+import time
+
+from . import nxpprog
+from . import nxpsim
+
+
+class _LegacySerialDevice(nxpprog.SerialDevice):
+    """SerialDevice with the old readline: 1 byte reads, timeout swapped per call."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._serial.timeout = self.timeout
+
+    def readline(self, timeout=None):
+        if timeout:
+            ot = self._serial.timeout
+            self._serial.timeout = timeout
+
+        line = b''
+        while True:
+            c = self._serial.read(1)
+            if not c:
+                break
+            if c == b'\r':
+                if not line:
+                    continue
+                else:
+                    break
+            if c == b'\n':
+                if not line:
+                    continue
+                else:
+                    break
+            line += c
+
+        if timeout:
+            self._serial.timeout = ot
+
+        return line.decode("UTF-8", "ignore")
+
+
+class PtyResponder(object):
+    """Answers every command line written to the pty with a canned response.
+
+    Args:
+        responses (dict): First word of a command -> response bytes. Other
+            commands get b'0\\r\\n' (CMD_SUCCESS).
+    """
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.master, slave = pty.openpty()
+        self.port = os.ttyname(slave)
+        self._slave = slave
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        buf = b''
+        while not self._stop:
+            try:
+                buf += os.read(self.master, 4096)
+            except OSError:
+                break
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                cmd = line.strip().split(b' ')[0].decode('ascii', 'ignore')
+                if cmd:
+                    os.write(self.master, self.responses.get(cmd, b'0\r\n'))
+
+    def close(self):
+        self._stop = True
+        os.close(self.master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def round_trip(device, n=500, cmd=b'J\r\n', lines=2):
+    """Time n commands on device, reading lines response lines each.
+
+    Returns:
+        float: mean seconds per command.
+    """
+    start = time.perf_counter()
+    for i in range(n):
+        device.write(cmd)
+        for j in range(lines):
+            if not device.readline():
+                raise IOError("No response to %r" % cmd)
+    return (time.perf_counter() - start) / n
+
+
+def benchmark(n=500):
+    """Mean ISP command round trip of the old and the buffered readline.
+
+    Returns:
+        dict: seconds per command for ``legacy`` and ``buffered``.
+    """
+    result = {}
+    responses = {'J': b'0\r\n67113001\r\n'}
+    for name, cls in (('legacy', _LegacySerialDevice), ('buffered', nxpprog.SerialDevice)):
+        with PtyResponder(responses) as responder:
+            device = cls(responder.port, 115200)
+            round_trip(device, 10)
+            result[name] = round_trip(device, n)
+            device._serial.close()
+    return result
+
+
+def _wire_time(n, baud):
+    # uu encoding sends 4 characters per 3 bytes, plus line ends
+    return (n * 4 / 3 + n / 45 * 3) * 10.0 / baud
+
+
+def benchmark_programmer(cpu="lpc1114", baud=115200, pacing=True, size=4096, quiet=True):
+    """Time the main NXP_Programmer operations against the simulated bootloader.
+
+    Args:
+        cpu (str): Part to simulate and program.
+        baud (int): Baud rate of the simulated link.
+        pacing (bool): Pace the simulator like a real part, False measures
+            the host side only.
+        size (int): Bytes read, written and programmed.
+        quiet (bool): Hide nxpprog's log messages.
+
+    Returns:
+        dict: operation -> {'seconds', 'bytes_per_second'}. read_block and
+        write_ram_data also get 'link_utilisation': time the uu data takes
+        on the wire at baud over the measured time.
+    """
+    sim = nxpsim.ISPSimulator(cpu, baud=baud, pacing=pacing)
+    port = sim.serve_pty()
+    old_log = nxpprog.log
+    if quiet:
+        nxpprog.log = lambda str: None
+    try:
+        device = nxpprog.SerialDevice(port, baud)
+        nxpp = nxpprog.NXP_Programmer(cpu, device, 12000)
+        image = os.urandom(size)
+        ram = nxpp.get_cpu_parm("flash_prog_buffer_base", nxpprog.flash_prog_buffer_base_default)
+        operations = (
+            ("prog_image", lambda: nxpp.prog_image(image, 0)),
+            ("verify_image", lambda: nxpp.verify_image(0, nxpp.insert_csum(image))),
+            ("read_block", lambda: nxpp.read_block(0, size)),
+            ("write_ram_data", lambda: nxpp.write_ram_data(ram, image[:1024])),
+            ("blank_check_all", lambda: nxpp.blank_check_all()),
+        )
+        result = {}
+        for name, operation in operations:
+            start = time.perf_counter()
+            operation()
+            seconds = time.perf_counter() - start
+            n = {"write_ram_data": 1024, "blank_check_all": len(sim.flash)}.get(name, size)
+            result[name] = {'seconds': seconds, 'bytes_per_second': n / seconds}
+            if name in ("read_block", "write_ram_data") and pacing:
+                result[name]['link_utilisation'] = _wire_time(n, baud) / seconds
+        if sim.flash[:size] != nxpp.insert_csum(image):
+            raise IOError("Flash contents don't match the programmed image")
+        device._serial.close()
+        return result
+    finally:
+        nxpprog.log = old_log
+        sim.close()
+
+
+if __name__ == "__main__":
+    result = benchmark()
+    for name, seconds in result.items():
+        print("{:8s}: {:8.1f} us per ISP command".format(name, seconds * 1e6))
+    print("speedup: {:.1f}x".format(result['legacy'] / result['buffered']))
+
+    print("\nlpc1114 at 115200 baud (simulated):")
+    for name, timing in benchmark_programmer().items():
+        print("{:16s} {:7.3f} s {:9.0f} B/s{}".format(name, timing['seconds'], timing['bytes_per_second'],
+              "  link utilisation {:.0%}".format(timing['link_utilisation']) if 'link_utilisation' in timing else ""))
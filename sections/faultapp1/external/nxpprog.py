@@ -27,9 +27,12 @@
 # processors.
 
 import binascii
+import hashlib
 import struct
 import time
 
+import numpy as np
+
 CMD_SUCCESS = 0
 INVALID_COMMAND = 1
 SRC_ADDR_ERROR = 2
@@ -100,6 +103,11 @@ flash_sector_lpc18xx = (
 flash_prog_buffer_base_default = 0x40001000
 flash_prog_buffer_size_default = 4096
 
+# (cpu, port) -> {(address, length): sha256 of the data last programmed and
+# verified there}, shared by every NXP_Programmer on that part so it
+# survives reconnecting (see verify_image(changed_only=True))
+verified_sectors = {}
+
 # cpu parameter table
 cpu_parms = {
         # 128k flash
@@ -397,6 +405,14 @@ def panic(str):
     
 
 class NXPSerialDevice(object):
+    # Largest single write nxpprog may make when sending data to RAM. None
+    # sends one uu line per write, for links that can't take long writes
+    # (e.g. the ChipWhisperer target serial port); set it to opt in to
+    # bulk writes.
+    max_write = None
+    # name of the link, keys the module level verified_sectors cache
+    port = None
+
     def __init__(self):
         '''Initialize port as required, interface-specific arguments.'''
         raise NotImplementedError("Required function")
@@ -414,9 +430,16 @@ class NXPSerialDevice(object):
 # Simple example of a serial port control
 import serial
 class SerialDevice(NXPSerialDevice):
+    poll_interval = 0.05
+    max_write = 4096
+
     def __init__(self, device, baud, xonxoff=False, control=False):
-        # Create the Serial object without port to avoid automatic opening
-        self._serial = serial.Serial(port=None, baudrate=baud)
+        # Create the Serial object without port to avoid automatic opening,
+        # pyserial URLs (e.g. socket://localhost:7777) are supported too
+        if "://" in device:
+            self._serial = serial.serial_for_url(device, baudrate=baud, do_not_open=True)
+        else:
+            self._serial = serial.Serial(port=None, baudrate=baud)
 
         # Disable RTS and DRT to avoid automatic reset to ISP mode (use --control for explicit reset)
         self._serial.setRTS(0)
@@ -425,12 +448,17 @@ class SerialDevice(NXPSerialDevice):
         # Select and open the port after RTS and DTR are set to zero
         self._serial.setPort(device)
         self._serial.open()
+        self.port = device
 
-        # set a two second timeout just in case there is nothing connected
+        # set a five second timeout just in case there is nothing connected
         # or the device is in the wrong mode.
         # This timeout is too short for slow baud rates but who wants to
         # use them?
-        self._serial.setTimeout(5)
+        self.timeout = 5
+        # the port itself only blocks for a short time, readline keeps
+        # reading until its own deadline
+        self._serial.timeout = self.poll_interval
+        self._rx = bytearray()
         # device wants Xon Xoff flow control
         if xonxoff:
             self._serial.setXonXoff(1)
@@ -470,32 +498,40 @@ class SerialDevice(NXPSerialDevice):
             self._serial.setRTS(level)
 
     def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('UTF-8')
         self._serial.write(data)
 
-    def readline(self, timeout=None):
-        if timeout:
-            ot = self._serial.getTimeout()
-            self._serial.setTimeout(timeout)
+    def _pop_line(self):
+        # drop empty lines, then split off everything up to the next CR/LF
+        rx = self._rx
+        start = 0
+        while start < len(rx) and rx[start] in b'\r\n':
+            start += 1
+        if start:
+            del rx[:start]
+        cr = rx.find(b'\r')
+        lf = rx.find(b'\n')
+        end = min(cr, lf) if cr >= 0 and lf >= 0 else max(cr, lf)
+        if end < 0:
+            return None
+        line = bytes(rx[:end])
+        del rx[:end + 1]
+        return line
 
-        line = b''
+    def readline(self, timeout=None):
+        deadline = time.monotonic() + (timeout or self.timeout)
         while True:
-            c = self._serial.read(1)
-            if not c:
+            line = self._pop_line()
+            if line is not None:
                 break
-            if c == b'\r':
-                if not line:
-                    continue
-                else:
-                    break
-            if c == b'\n':
-                if not line:
-                    continue
-                else:
-                    break
-            line += c
-
-        if timeout:
-            self._serial.setTimeout(ot)
+            if time.monotonic() >= deadline:
+                # timed out, return whatever came in
+                line = bytes(self._rx)
+                del self._rx[:]
+                break
+            # blocks for at most poll_interval if nothing is waiting
+            self._rx += self._serial.read(self._serial.in_waiting or 1)
 
         return line.decode("UTF-8", "ignore")
 
@@ -519,6 +555,10 @@ class NXP_Programmer(object):
 
         self.cpu = cpu
 
+        # this part's entry in the module level verified_sectors
+        self.verified_sectors = verified_sectors.setdefault(
+                (cpu, getattr(device, "port", None)), {})
+
         self.connection_init(osc_freq)
 
         self.banks = self.get_cpu_parm("flash_bank_addr", 0)
@@ -560,6 +600,16 @@ class NXP_Programmer(object):
     def dev_write(self, data):
         self.device.write(data)
 
+    def dev_write_bulk(self, data):
+        # only devices that set max_write get more than one line per write
+        step = getattr(self.device, "max_write", None)
+        if not step:
+            for line in data.splitlines(True):
+                self.device.write(line)
+            return
+        for i in range(0, len(data), step):
+            self.device.write(data[i:i + step])
+
     def dev_writeln(self, data):
         data = data.encode('UTF-8') + b'\r\n'
         # print('> ' + data)
@@ -678,129 +728,143 @@ class NXP_Programmer(object):
 
 
     def sum(self, data):
-        s = 0
         if isinstance(data, str):
-            for ch in data:
-                s += ord(ch)
-        else:
-            for i in data:
-                s += i
-        return s
+            data = data.encode('latin-1')
+        return int(np.frombuffer(data, dtype=np.uint8).sum(dtype=np.uint64))
 
 
-    def write_ram_block(self, addr, data):
-        data_len = len(data)
+    def uudecode(self, line, out=None):
+        if not line:
+            panic("Read timeout")
 
-        for i in range(0, data_len, self.uu_line_size):
-            c_line_size = data_len - i
-            if c_line_size > self.uu_line_size:
-                c_line_size = self.uu_line_size
-            block = data[i:i+c_line_size]
-            bstr = binascii.b2a_uu(block)
-            self.dev_write(bstr)
-
-        retry = 3
-        while retry > 0:
-            retry -= 1
-            self.dev_writeln('%s' % self.sum(data))
-            status = self.dev_readline()
-            print(status)
-            if status:
-                break
-        if not status:
-            return "timeout"
-        if status == self.RESEND:
-            return "resend"
-        if status == self.OK:
-            return ""
-
-        # unknown status result
-        panic(status)
-
-    def uudecode(self, line):
         # uu encoded data has an encoded length first
-        linelen = ord(line[0]) - 32
+        linelen = (ord(line[0]) - 32) % 64
 
         uu_linelen = (linelen + 3 - 1) // 3 * 4
 
         if uu_linelen + 1 != len(line):
             panic("Error in line length")
 
-        # pure python implementation - if this was C we would
-        # use bitshift operations here
-        decoded = ""
-        for i in range(1, len(line), 4):
-            c = 0
-            for j in line[i: i + 4]:
-                ch = ord(j) - 32
-                ch %= 64
-                c = c * 64 + ch
-            s = []
-            for j in range(0, 3):
-                s.append(c % 256)
-                c = c // 256
-            for j in reversed(s):
-                decoded = decoded + chr(j)
-
-        # only return real data
-        return decoded[0:linelen]
-
-
-    def read_block(self, addr, data_len, fd=None):
+        try:
+            decoded = binascii.a2b_uu(line)
+        except binascii.Error as e:
+            panic("Error in uu data: %s" % e)
+
+        # optionally copy straight into the caller's buffer
+        if out is not None:
+            if linelen > len(out):
+                panic("Too much data")
+            out[:linelen] = decoded
+        return decoded
+
+
+    def read_block(self, addr, data_len, fd=None, out=None):
+        """Read data_len bytes of memory at addr.
+
+        Returns the data as bytes. If fd (a binary file) is given the data is
+        written to it instead, and if out (a bytearray/memoryview of at least
+        data_len bytes) is given it is decoded straight into it; both return
+        None.
+        """
         self.isp_command("R %d %d" % ( addr, data_len ))
 
         expected_lines = (data_len + self.uu_line_size - 1) // self.uu_line_size
 
-        data = ""
+        if fd:
+            # streaming: one block's worth of buffer, reused for every block
+            buf = memoryview(bytearray(self.uu_block_size))
+        elif out is None:
+            buf = memoryview(bytearray(data_len))
+        else:
+            buf = memoryview(out).cast('B')
+        pos = 0
+        total = 0
         for i in range(0, expected_lines, 20):
             lines = expected_lines - i
             if lines > 20:
                 lines = 20
-            cdata = ""
+            if fd:
+                pos = 0
+            start = pos
             for i in range(0, lines):
                 line = self.dev_readline()
 
-                decoded = self.uudecode(line)
+                pos += len(self.uudecode(line, buf[pos:]))
 
-                cdata += decoded
+            cdata = buf[start:pos]
+            total += len(cdata)
+            csum = self.sum(cdata)
 
             s = self.dev_readline()
 
-            if int(s) != self.sum(cdata):
-                panic("Checksum mismatch on read got 0x%x expected 0x%x" % (int(s), self.sum(data)))
+            if int(s) != csum:
+                panic("Checksum mismatch on read got 0x%x expected 0x%x" % (int(s), csum))
             else:
                 self.dev_writeln(self.OK)
 
             if fd:
                 fd.write(cdata)
-            else:
-                data += cdata
 
-        if fd:
+        if total != data_len:
+            panic("Read %d bytes, expected %d" % (total, data_len))
+        if fd or out is not None:
             return None
         else:
-            return data
+            return bytes(buf)
+
+    def uu_groups(self, data):
+        # every 20 uu lines and the checksum line that follows them,
+        # encoded up front so each group goes out with a single write
+        groups = []
+        for i in range(0, len(data), self.uu_block_size):
+            block = data[i:i + self.uu_block_size]
+            lines = b''.join(binascii.b2a_uu(block[j:j + self.uu_line_size])
+                             for j in range(0, len(block), self.uu_line_size))
+            groups.append((lines, b'%d\r\n' % self.sum(block)))
+        return groups
+
+
+    def write_ram_groups(self, groups):
+        for lines, csum in groups:
+            self.dev_write_bulk(lines + csum)
+            retry = 3
+            while retry > 0:
+                retry -= 1
+                status = self.dev_readline()
+                if status == self.OK:
+                    break
+                elif status == self.RESEND:
+                    if retry:
+                        log("Resending")
+                        self.dev_write_bulk(lines + csum)
+                elif not status:
+                    if retry:
+                        self.dev_write(csum)
+                else:
+                    # unknown status result
+                    panic(status)
+            else:
+                panic("Write error: %s" % ("resend" if status else "timeout"))
 
-    def write_ram_data(self, addr, data):
+
+    def write_ram_data(self, addr, data, block_size=None):
+        # one W command per block_size bytes (by default all the part's RAM
+        # buffer holds), each sent as pre-encoded 20 line groups
+        if block_size is None:
+            block_size = self.get_cpu_parm("flash_prog_buffer_size",
+                    flash_prog_buffer_size_default)
         image_len = len(data)
-        for i in range(0, image_len, self.uu_block_size):
+        for i in range(0, image_len, block_size):
 
             a_block_size = image_len - i
-            if a_block_size > self.uu_block_size:
-                a_block_size = self.uu_block_size
+            if a_block_size > block_size:
+                a_block_size = block_size
+
+            groups = self.uu_groups(data[i : i + a_block_size])
 
             self.isp_command("W %d %d" % ( addr, a_block_size ))
 
-            retry = 3
-            while retry > 0:
-                retry -= 1
-                err = self.write_ram_block(addr, data[i : i + a_block_size])
-                if not err:
-                    break
-                elif err != "resend":
-                    panic("Write error: %s" % err)
-                else:
-                    log("Resending")
+            self.write_ram_groups(groups)
 
             addr += a_block_size
 
@@ -867,7 +931,45 @@ class NXP_Programmer(object):
             self.isp_command("P %d %d" % (start_sector, end_sector))
 
 
+    def sector_range(self, sector):
+        # (first address, address after the end) of a flash sector
+        table = self.get_cpu_parm("flash_sector")
+        flash_base_addr = self.get_cpu_parm("flash_bank_addr", 0)
+        if flash_base_addr == 0:
+            faddr = 0
+        else:
+            faddr = flash_base_addr[0] # fix to have a current flash bank
+        return (faddr + 1024 * sum(table[:sector]),
+                faddr + 1024 * sum(table[:sector+1]))
+
+
+    def forget_verified(self, start_addr, end_addr):
+        # flash in [start_addr, end_addr) is being changed, so earlier
+        # verify_image results for it don't hold anymore
+        for key in list(self.verified_sectors):
+            start, length = key
+            if start < end_addr and start + length > start_addr:
+                del self.verified_sectors[key]
+
+
+    def unchanged_verified(self, flash_addr_base, image):
+        # the verified_sectors entries inside image that image rewrites
+        # with the same data
+        unchanged = {}
+        for key, digest in self.verified_sectors.items():
+            start, length = key
+            index = start - flash_addr_base
+            if index >= 0 and index + length <= len(image) and \
+                    hashlib.sha256(image[index:index + length]).digest() == digest:
+                unchanged[key] = digest
+        return unchanged
+
+
     def erase_sectors(self, start_sector, end_sector, verify=False):
+        # before anything is sent, so a failed erase is forgotten too
+        self.forget_verified(self.sector_range(start_sector)[0],
+                self.sector_range(end_sector)[1])
+
         self.prepare_flash_sectors(start_sector, end_sector)
 
         log("Erasing flash sectors %d-%d" % (start_sector, end_sector))
@@ -968,10 +1070,20 @@ class NXP_Programmer(object):
 
         log("Padding with %d bytes" % pad_count)
 
+        # the erase forgets every verify result in range, the ones for
+        # sectors getting the same data back are restored once it's written
+        unchanged = self.unchanged_verified(flash_addr_base, image)
+        self.forget_verified(flash_addr_base, flash_addr_base + image_len)
+
+        # seconds spent in each phase, logged at the end
+        self.timing = dict.fromkeys(("erase", "ram_write", "copy", "verify"), 0.0)
+        t = time.perf_counter()
+
         if erase_all:
             self.erase_all(verify)
         else:
             self.erase_flash_range(flash_addr_base, flash_addr_base + image_len - 1, verify)
+        t = self._phase("erase", t)
 
         for image_index in range(0, image_len, ram_block):
             a_ram_block = image_len - image_index
@@ -984,7 +1096,8 @@ class NXP_Programmer(object):
             log("Writing %d bytes to 0x%x" % (a_ram_block, flash_addr_start))
 
             self.write_ram_data(ram_addr,
-                    image[image_index: image_index + a_ram_block])
+                    image[image_index: image_index + a_ram_block], ram_block)
+            t = self._phase("ram_write", t)
 
             s_flash_sector = self.find_flash_sector(flash_addr_start)
 
@@ -995,6 +1108,7 @@ class NXP_Programmer(object):
             # copy ram to flash
             self.isp_command("C %d %d %d" %
                     (flash_addr_start, ram_addr, a_ram_block))
+            t = self._phase("copy", t)
 
             # optionally compare ram and flash
             if verify:
@@ -1010,52 +1124,77 @@ class NXP_Programmer(object):
                     success = False
                 else:
                     self.errexit("'%s' error" % cmd, status)
+                t = self._phase("verify", t)
+
+        log("Timing: " + ", ".join("%s %.3fs" % item for item in self.timing.items()))
+
+        if success:
+            self.verified_sectors.update(unchanged)
 
         return success
 
 
-    def verify_image(self, flash_addr_base, image):
+    def _phase(self, name, start):
+        # add the time since start to phase name, returns the current time
+        now = time.perf_counter()
+        self.timing[name] += now - start
+        return now
+
+
+    def verify_image(self, flash_addr_base, image, changed_only=False):
+        """Compare flash with image, one sector at a time.
+
+        Each sector is read with a single R command and compared with NumPy.
+        With changed_only, sectors whose part of image is the same as when
+        they last passed verification on this part (see verified_sectors,
+        kept per cpu and port across programmer instances) aren't read.
+        Erasing a sector, or programming different data into it, forgets
+        its result.
+        Returns True if everything matches.
+        """
         success = True
 
+        if isinstance(image, str):
+            image = image.encode('latin-1')
+        image = np.frombuffer(image, dtype=np.uint8)
         image_length = len(image)
         start_addr = flash_addr_base
         end_addr = flash_addr_base + image_length
 
         start_sector = self.find_flash_sector(start_addr)
-        end_sector = self.find_flash_sector(end_addr)
+        end_sector = self.find_flash_sector(end_addr - 1)
 
         table = self.get_cpu_parm("flash_sector")
-        flash_base_addr = self.get_cpu_parm("flash_bank_addr", 0)
-        if flash_base_addr == 0:
-            faddr = 0
-        else:
-            faddr = flash_base_addr[0] # fix to have a current flash bank
-
-        index = 0
+        buf = bytearray(1024 * max(table))
         sector = start_sector
         while sector <= end_sector:
-            start_of_sector = faddr + 1024 * sum(table[:sector])
-            end_of_sector = faddr + 1024 * sum(table[:sector+1])
+            start_of_sector, end_of_sector = self.sector_range(sector)
 
             start = start_addr if start_of_sector < start_addr else start_of_sector
             end = end_addr if end_of_sector > end_addr else end_of_sector
             length = 4 * ((end - start) // 4)
+            index = start - start_addr
+            expected = image[index:index + length]
 
-            log("Verify sector %i: Reading %d bytes from 0x%x" % (sector, length, start))
-            data = self.read_block(start, length)
-            if isinstance(image[0], int):
-                data = [ord(x) for x in data]
-
-            if len(data) != length:
-                panic("Verify failed! lengths differ")
+            key = (start, length)
+            digest = hashlib.sha256(expected).digest()
+            if changed_only and self.verified_sectors.get(key) == digest:
+                log("Verify sector %i: unchanged, skipped" % sector)
+                sector = sector + 1
+                continue
 
-            for (i, (x, y)) in enumerate(zip(data, image[index:index+(end-start)])):
-                if x != y:
-                    log("Verify failed! content differ at location 0x%x" % (faddr + i))
-                    success = False
-                    break
+            log("Verify sector %i: Reading %d bytes from 0x%x" % (sector, length, start))
+            self.read_block(start, length, out=buf)
+            data = np.frombuffer(buf, dtype=np.uint8, count=length)
+
+            if not np.array_equal(data, expected):
+                i = np.flatnonzero(data != expected)[0]
+                log("Verify failed! content differ at location 0x%x" % (start + i))
+                self.verified_sectors.pop(key, None)
+                success = False
+            else:
+                self.verified_sectors[key] = digest
 
-            index = index + length
             sector = sector + 1
 
         return success
@@ -0,0 +1,406 @@
+"""Simulated NXP LPC ISP bootloader, for testing nxpprog without hardware.
+
+``ISPSimulator`` speaks the UART ISP protocol of the LPC parts in
+``nxpprog.cpu_parms``: the ``?``/``Synchronized`` handshake, ``U``, ``A``,
+``J``, ``N``, ``R``, ``W``, ``P``, ``E``, ``I``, ``C``, ``M`` and ``G``, with
+the code read protection (CRP) level read from flash offset 0x2FC on every
+reset, like the real boot ROM. Every byte is delayed by its time on the wire
+at ``baud`` (10 bits per byte), and erase/program take their datasheet times,
+so timings are close to a real part at that baud rate. ``pacing=False`` runs
+as fast as possible.
+
+It is served on a pseudo terminal (Linux, macOS) or a TCP socket, which
+``nxpprog.SerialDevice`` opens like any other port::
+
+    sim = ISPSimulator("lpc1114", baud=115200)
+    port = sim.serve_pty()                  # or sim.serve_socket() -> "socket://..."
+    device = nxpprog.SerialDevice(port, 115200)
+    nxpp = nxpprog.NXP_Programmer("lpc1114", device, 12000)
+"""
+import binascii
+import os
+import socket
+import threading
+import time
+
+from . import nxpprog
+
+CRP1 = 0x12345678
+CRP2 = 0x87654321
+CRP3 = 0x43218765
+CRP_ADDR = 0x2fc
+
+
+class _Reset(Exception):
+    pass
+
+
+class ISPSimulator(object):
+    """LPC ISP bootloader state machine.
+
+    Args:
+        cpu (str): Part from ``nxpprog.cpu_parms``, sets the flash layout,
+            RAM buffer and device id.
+        baud (int): Baud rate the byte pacing is based on.
+        pacing (bool): Delay bytes, erase and program operations like a real
+            part. False answers immediately.
+        echo (bool): Echo received lines, as the boot ROM does until "A 0".
+        erase_time (float): Seconds per sector erase.
+        program_time (float): Seconds per 256 bytes written by C.
+    """
+    def __init__(self, cpu="lpc1114", baud=115200, pacing=True, echo=True,
+                 erase_time=0.1, program_time=0.001):
+        parms = nxpprog.cpu_parms[cpu]
+        self.cpu = cpu
+        self.baud = baud
+        self.pacing = pacing
+        self.erase_time = erase_time
+        self.program_time = program_time
+        self.sectors = [1024 * size for size in parms["flash_sector"]]
+        self.flash_base = parms.get("flash_bank_addr", (0,))[0]
+        self.flash = bytearray(b'\xff' * sum(self.sectors))
+        buffer_base = parms.get("flash_prog_buffer_base", nxpprog.flash_prog_buffer_base_default)
+        buffer_size = parms.get("flash_prog_buffer_size", nxpprog.flash_prog_buffer_size_default)
+        self.ram_base = buffer_base & ~0xffff
+        self.ram = bytearray(buffer_base - self.ram_base + buffer_size + 0x1000)
+        devid = parms.get("devid", 0)
+        self.devid = devid if isinstance(devid, tuple) else (devid,)
+        self.serial_number = (0x1234, 0x5678, 0x9abc, 0xdef0)
+        self._echo_default = echo
+        self._rx = bytearray()
+        self.stats = {'commands': 0, 'bytes_in': 0, 'bytes_out': 0}
+        self._pending_reset = False
+        self._reset_state()
+
+    def reset(self):
+        """Reset the part: back to waiting for "?", CRP re-read from flash.
+
+        Can be called from another thread while serving, like pulling nRST.
+        """
+        self._reset_state()
+        self._pending_reset = True
+
+    def _reset_state(self):
+        self.synced = False
+        self.echo = self._echo_default
+        self.unlocked = False
+        self.prepared = None
+        word = self.flash[CRP_ADDR:CRP_ADDR + 4]
+        crp = int.from_bytes(word, 'little') if len(word) == 4 else 0
+        self.crp = {CRP1: 1, CRP2: 2, CRP3: 3}.get(crp, 0)
+
+    # transport
+
+    def _wire(self, n):
+        if self.pacing:
+            time.sleep(n * 10.0 / self.baud)
+
+    def _send(self, data):
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        self._wire(len(data))
+        self.stats['bytes_out'] += len(data)
+        self._write(data)
+
+    def _sendln(self, *lines):
+        self._send("".join("%s\r\n" % line for line in lines))
+
+    def _fill(self):
+        data = self._read(4096)
+        if not data:
+            raise EOFError()
+        self._wire(len(data))
+        self.stats['bytes_in'] += len(data)
+        if self._pending_reset:
+            # whatever came in before the reset is lost
+            self._pending_reset = False
+            del self._rx[:]
+            self._rx += data
+            raise _Reset()
+        self._rx += data
+
+    def _recv_line(self):
+        # lines end in LF (uu data) or CR LF (everything else)
+        while b'\n' not in self._rx:
+            self._fill()
+        end = self._rx.index(b'\n')
+        line = bytes(self._rx[:end]).rstrip(b'\r')
+        del self._rx[:end + 1]
+        if self.echo:
+            self._send(line + b'\r\n')
+        return line.decode('ascii', 'ignore')
+
+    def serve(self, read, write):
+        """Run the bootloader on a byte stream until read() returns b''."""
+        self._read, self._write = read, write
+        try:
+            while True:
+                try:
+                    if not self.synced:
+                        self._sync()
+                    else:
+                        self._command(self._recv_line())
+                except _Reset:
+                    pass
+        except (EOFError, OSError):
+            pass
+
+    def _start(self, read, write):
+        thread = threading.Thread(target=self.serve, args=(read, write), daemon=True)
+        thread.start()
+        return thread
+
+    def serve_pty(self):
+        """Serve on a new pseudo terminal. Returns the port name to open."""
+        import pty
+        import tty
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        self._fds = (master, slave)
+        self._start(lambda n: os.read(master, n), lambda data: os.write(master, data))
+        return os.ttyname(slave)
+
+    def serve_socket(self, host="localhost", port=0):
+        """Serve one connection on a TCP socket. Returns a pyserial URL to open."""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(1)
+        self._server = server
+
+        def accept():
+            conn, addr = server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.serve(conn.recv, conn.sendall)
+            conn.close()
+
+        threading.Thread(target=accept, daemon=True).start()
+        return "socket://%s:%d" % server.getsockname()[:2]
+
+    def close(self):
+        for fd in getattr(self, '_fds', ()):
+            os.close(fd)
+        if getattr(self, '_server', None):
+            self._server.close()
+
+    # protocol
+
+    def _sync(self):
+        # autobaud: wait for "?", then the two handshake lines
+        while b'?' not in self._rx:
+            self._fill()
+        del self._rx[:self._rx.index(b'?') + 1]
+        self._reset_state()
+        if self.crp == 3:
+            # CRP3 disables ISP entirely, the part never answers
+            while True:
+                self._fill()
+        self._sendln("Synchronized")
+        if self._recv_line() != "Synchronized":
+            return
+        self._sendln("OK")
+        self._recv_line() # crystal frequency in kHz
+        self._sendln("OK")
+        self.synced = True
+
+    def _command(self, line):
+        words = line.split()
+        if not words:
+            return
+        self.stats['commands'] += 1
+        handler = getattr(self, '_cmd_' + words[0], None)
+        try:
+            args = [int(w) for w in words[1:]]
+        except ValueError:
+            return self._sendln(nxpprog.PARAM_ERROR)
+        if handler is None:
+            return self._sendln(nxpprog.INVALID_COMMAND)
+        if words[0] in ("W", "C", "E", "G") and not self.unlocked:
+            return self._sendln(nxpprog.CMD_LOCKED)
+        status = handler(*args) if self._params_ok(handler, args) else nxpprog.PARAM_ERROR
+        if status is not None:
+            self._sendln(status)
+
+    def _params_ok(self, handler, args):
+        code = handler.__code__
+        return code.co_argcount - 1 - len(handler.__defaults__ or ()) <= len(args) <= code.co_argcount - 1
+
+    def _sector_range(self, start, end):
+        if not 0 <= start <= end < len(self.sectors):
+            return None
+        base = self.flash_base + sum(self.sectors[:start])
+        return base, self.flash_base + sum(self.sectors[:end + 1])
+
+    def _all_sectors(self, start, end):
+        return start == 0 and end == len(self.sectors) - 1
+
+    def _ram(self, addr, n):
+        offset = addr - self.ram_base
+        if offset < 0 or offset + n > len(self.ram):
+            return None
+        return offset
+
+    def _cmd_U(self, code):
+        if code != 23130:
+            return nxpprog.INVALID_CODE
+        self.unlocked = True
+        return nxpprog.CMD_SUCCESS
+
+    def _cmd_A(self, on):
+        # the reply to A 0 is still echoed
+        self._sendln(nxpprog.CMD_SUCCESS)
+        self.echo = bool(on)
+
+    def _cmd_J(self):
+        self._sendln(nxpprog.CMD_SUCCESS, *self.devid)
+
+    def _cmd_N(self):
+        self._sendln(nxpprog.CMD_SUCCESS, *self.serial_number)
+
+    def _cmd_G(self, addr, mode=None):
+        if self.crp >= 2:
+            return nxpprog.CODE_READ_PROTECTION_ENABLED
+        return nxpprog.CMD_SUCCESS
+
+    def _read_memory(self, addr, n):
+        flash = addr - self.flash_base
+        if 0 <= flash and flash + n <= len(self.flash):
+            return bytes(self.flash[flash:flash + n])
+        offset = self._ram(addr, n)
+        if offset is not None:
+            return bytes(self.ram[offset:offset + n])
+        return None
+
+    def _cmd_R(self, addr, n):
+        if self.crp:
+            return nxpprog.CODE_READ_PROTECTION_ENABLED
+        if addr % 4:
+            return nxpprog.ADDR_ERROR
+        if n % 4:
+            return nxpprog.COUNT_ERROR
+        data = self._read_memory(addr, n)
+        if data is None:
+            return nxpprog.ADDR_NOT_MAPPED
+        self._sendln(nxpprog.CMD_SUCCESS)
+        i = 0
+        while i < n:
+            block = data[i:i + 900]
+            lines = b''.join(binascii.b2a_uu(block[j:j + 45]).replace(b'\n', b'\r\n')
+                             for j in range(0, len(block), 45))
+            self._send(lines + b'%d\r\n' % sum(block))
+            reply = self._recv_line()
+            if reply == "OK":
+                i += len(block)
+            elif reply != "RESEND":
+                return
+
+    def _cmd_W(self, addr, n):
+        if addr % 4:
+            return nxpprog.DST_ADDR_ERROR
+        if n % 4:
+            return nxpprog.COUNT_ERROR
+        offset = self._ram(addr, n)
+        if offset is None:
+            return nxpprog.DST_ADDR_NOT_MAPPED
+        if self.crp == 1 and addr < self.ram_base + 0x300:
+            return nxpprog.CODE_READ_PROTECTION_ENABLED
+        if self.crp >= 2:
+            return nxpprog.CODE_READ_PROTECTION_ENABLED
+        self._sendln(nxpprog.CMD_SUCCESS)
+        received = 0
+        while received < n:
+            block = bytearray()
+            lines = 0
+            while lines < 20 and received + len(block) < n:
+                block += binascii.a2b_uu(self._recv_line())
+                lines += 1
+            csum = self._recv_line()
+            if csum.isdigit() and int(csum) == sum(block):
+                self.ram[offset + received:offset + received + len(block)] = block
+                received += len(block)
+                self._sendln("OK")
+            else:
+                self._sendln("RESEND")
+
+    def _cmd_P(self, start, end, bank=None):
+        if self._sector_range(start, end) is None:
+            return nxpprog.INVALID_SECTOR
+        self.prepared = (start, end)
+        return nxpprog.CMD_SUCCESS
+
+    def _is_prepared(self, start, end):
+        return self.prepared is not None and self.prepared[0] <= start and end <= self.prepared[1]
+
+    def _cmd_E(self, start, end, bank=None):
+        sectors = self._sector_range(start, end)
+        if sectors is None:
+            return nxpprog.INVALID_SECTOR
+        if not self._is_prepared(start, end):
+            return nxpprog.SECTOR_NOT_PREPARED_FOR_WRITE_OPERATION
+        if self.crp and not self._all_sectors(start, end):
+            return nxpprog.CODE_READ_PROTECTION_ENABLED
+        if self.pacing:
+            time.sleep(self.erase_time * (end - start + 1))
+        first, last = sectors
+        self.flash[first - self.flash_base:last - self.flash_base] = b'\xff' * (last - first)
+        self.prepared = None
+        return nxpprog.CMD_SUCCESS
+
+    def _cmd_I(self, start, end, bank=None):
+        sectors = self._sector_range(start, end)
+        if sectors is None:
+            return nxpprog.INVALID_SECTOR
+        first, last = (a - self.flash_base for a in sectors)
+        data = self.flash[first:last]
+        blank = data.count(b'\xff') == len(data)
+        if blank:
+            return nxpprog.CMD_SUCCESS
+        offset = next(i for i, b in enumerate(data) if b != 0xff) & ~3
+        word = int.from_bytes(data[offset:offset + 4], 'little')
+        self._sendln(nxpprog.SECTOR_NOT_BLANK, first + offset, word)
+
+    def _cmd_C(self, dst, src, n):
+        if dst % 256:
+            return nxpprog.DST_ADDR_ERROR
+        if n not in (256, 512, 1024, 4096):
+            return nxpprog.COUNT_ERROR
+        offset = self._ram(src, n)
+        if offset is None:
+            return nxpprog.SRC_ADDR_NOT_MAPPED
+        flash = dst - self.flash_base
+        if flash < 0 or flash + n > len(self.flash):
+            return nxpprog.DST_ADDR_NOT_MAPPED
+        if self.crp >= 2 or (self.crp == 1 and flash < self.sectors[0]):
+            return nxpprog.CODE_READ_PROTECTION_ENABLED
+        first = self._sector_of(flash)
+        last = self._sector_of(flash + n - 1)
+        if not self._is_prepared(first, last):
+            return nxpprog.SECTOR_NOT_PREPARED_FOR_WRITE_OPERATION
+        if self.pacing:
+            time.sleep(self.program_time * n / 256)
+        # programming can only clear bits
+        old = int.from_bytes(self.flash[flash:flash + n], 'little')
+        new = int.from_bytes(self.ram[offset:offset + n], 'little')
+        self.flash[flash:flash + n] = (old & new).to_bytes(n, 'little')
+        self.prepared = None
+        return nxpprog.CMD_SUCCESS
+
+    def _cmd_M(self, a, b, n):
+        if self.crp:
+            return nxpprog.CODE_READ_PROTECTION_ENABLED
+        if a % 4 or b % 4:
+            return nxpprog.ADDR_ERROR
+        x, y = self._read_memory(a, n), self._read_memory(b, n)
+        if x is None or y is None:
+            return nxpprog.ADDR_NOT_MAPPED
+        if x == y:
+            return nxpprog.CMD_SUCCESS
+        offset = next(i for i in range(n) if x[i] != y[i]) & ~3
+        self._sendln(nxpprog.COMPARE_ERROR, offset)
+
+    def _sector_of(self, offset):
+        for i in range(len(self.sectors)):
+            offset -= self.sectors[i]
+            if offset < 0:
+                return i
+        return len(self.sectors)
@@ -0,0 +1,227 @@
+"""Batched trace resynchronization with SAD and DTW.
+
+The Lab 1_1 notebooks resync one trace at a time in a Python loop (or with
+``cwa.preprocessing.ResyncSAD``/``ResyncDTW``, which do the same). The
+functions here take a whole ``(N, samples)`` array, which can also be a
+``np.memmap`` or a zarr array, and work on chunks of traces at once, on a
+process pool::
+
+    from resync import resync_sad, resync_dtw
+    aligned, shifts = resync_sad(proj.waves, proj.waves[0], window=(1700, 2000), max_shift=700)
+    aligned, shifts = resync_dtw(traces, traces[0], radius=50)
+
+Each chunk is read from ``traces`` only when a worker is free, so inputs
+larger than memory work; pass ``out`` (e.g. a memmap or zarr array of the
+same shape) to write the aligned traces there too.
+"""
+import numpy as np
+
+
+def _sad_shifts(traces, ref, window, max_shift):
+    start, end = window
+    samples = traces.shape[1]
+    pattern = ref[start:end]
+    sad = np.full((len(traces), 2 * max_shift + 1), np.inf)
+    for k, shift in enumerate(range(-max_shift, max_shift + 1)):
+        if start + shift < 0 or end + shift > samples:
+            continue
+        sad[:, k] = np.abs(traces[:, start + shift:end + shift] - pattern).sum(axis=1)
+    return sad.argmin(axis=1) - max_shift
+
+
+def shift_traces(traces, shifts):
+    """Returns traces with trace i moved left by shifts[i] samples, zero filled.
+
+    So aligned[i, j] = traces[i, j + shifts[i]].
+    """
+    index = np.arange(traces.shape[1]) + np.asarray(shifts)[:, np.newaxis]
+    valid = (index >= 0) & (index < traces.shape[1])
+    aligned = np.take_along_axis(traces, np.clip(index, 0, traces.shape[1] - 1), axis=1)
+    aligned[~valid] = 0
+    return aligned
+
+
+def _resync_sad_chunk(traces, ref, window, max_shift):
+    traces = np.asarray(traces, dtype=np.float64)
+    shifts = _sad_shifts(traces, ref, window, max_shift)
+    return shift_traces(traces, shifts), shifts
+
+
+def _dtw_chunk(traces, ref, radius):
+    # DTW of every trace against ref in a Sakoe-Chiba band: ref sample i can
+    # only match trace samples i - radius .. i + radius. Band column b of
+    # row i is trace sample j = i + b - radius. A row is computed for the
+    # whole chunk at once: D[j] = c[j] + min(a[j], D[j - 1]), with a the
+    # best of the row above, is a min-plus scan, which is
+    # D = C + cummin(a - C[j - 1]) with C the running sum of c along the row.
+    n, samples = traces.shape
+    width = 2 * radius + 1
+    rows = np.arange(n)
+    band = np.arange(width) - radius
+    inf = np.inf
+    prev = np.full((n, width), inf)
+    prev[:, radius] = 0 # D[-1, -1]
+    # 0: diagonal, 1: up (same trace sample), 2: left (same ref sample)
+    moves = np.empty((len(ref), n, width), dtype=np.int8)
+    for i in range(len(ref)):
+        j = i + band
+        valid = (j >= 0) & (j < samples)
+        up = np.empty_like(prev)
+        up[:, :-1] = prev[:, 1:]
+        up[:, -1] = inf
+        a = np.minimum(prev, up)
+        c = np.zeros((n, width))
+        c[:, valid] = np.abs(traces[:, j[valid]] - ref[i])
+        C = np.cumsum(c, axis=1)
+        shifted = np.zeros_like(C)
+        shifted[:, 1:] = C[:, :-1]
+        D = C + np.minimum.accumulate(a - shifted, axis=1)
+        left = np.zeros((n, width), dtype=bool)
+        left[:, 1:] = D[:, :-1] < a[:, 1:]
+        moves[i] = np.where(left, 2, (up < prev).astype(np.int8))
+        D[:, ~valid] = inf
+        prev = D
+
+    # walk all the paths back from (last ref sample, last trace sample) together,
+    # averaging the trace samples matched to each ref sample
+    i = np.full(n, len(ref) - 1)
+    b = np.full(n, radius + samples - len(ref))
+    total = np.zeros((n, len(ref)))
+    count = np.zeros((n, len(ref)))
+    offset = np.zeros((n, len(ref)))
+    active = np.ones(n, dtype=bool)
+    while active.any():
+        t = rows[active]
+        it, bt = i[active], b[active]
+        jt = it + bt - radius
+        total[t, it] += traces[t, jt]
+        count[t, it] += 1
+        offset[t, it] += jt - it
+        move = moves[it, t, bt]
+        done = (it == 0) & (jt == 0)
+        it = np.where(move == 2, it, it - 1)
+        bt = bt + np.where(move == 1, 1, np.where(move == 2, -1, 0))
+        i[t], b[t] = it, bt
+        active[t[done]] = False
+    # the median ignores the ends, where every path is pulled to the corners
+    return total / count, np.rint(np.median(offset / count, axis=1)).astype(int)
+
+
+def _resync_dtw_chunk(traces, ref, radius):
+    return _dtw_chunk(np.asarray(traces, dtype=np.float64), ref, radius)
+
+
+def _run(func, traces, args, chunk, processes, out):
+    """Applies func(traces[a:b], *args) -> (aligned, shifts) over chunks of traces."""
+    total = len(traces)
+    if out is None:
+        out = np.empty(traces.shape, dtype=np.result_type(traces.dtype, np.float32))
+    shifts = np.empty(total, dtype=int)
+    ranges = [(a, min(a + chunk, total)) for a in range(0, total, chunk)]
+
+    def store(a, b, result):
+        out[a:b], shifts[a:b] = result
+
+    if processes == 1:
+        for a, b in ranges:
+            store(a, b, func(traces[a:b], *args))
+        return out, shifts
+
+    import multiprocessing
+    from multiprocessing.pool import Pool
+    processes = processes or multiprocessing.cpu_count()
+    with Pool(processes) as pool:
+        # keep a couple of chunks per worker in flight, so only those are in memory
+        pending = []
+        for a, b in ranges:
+            pending.append((a, b, pool.apply_async(func, (np.asarray(traces[a:b]),) + args)))
+            if len(pending) >= 2 * processes:
+                a0, b0, result = pending.pop(0)
+                store(a0, b0, result.get())
+        for a, b, result in pending:
+            store(a, b, result.get())
+    return out, shifts
+
+
+def resync_sad(traces, ref, window, max_shift, chunk=256, processes=None, out=None):
+    """Aligns traces to ref by the sum of absolute differences over a window.
+
+    Same method as ``cwa.preprocessing.ResyncSAD``: ref[window[0]:window[1]]
+    is compared with every trace at shifts -max_shift..max_shift, and each
+    trace is moved by the shift with the smallest SAD.
+
+    Args:
+        traces: (N, samples) array, np.memmap or zarr array.
+        ref: Reference trace, (samples,).
+        window (tuple): (start, end) of the pattern in ref.
+        max_shift (int): Largest shift searched, in samples.
+        chunk (int): Traces per task.
+        processes (int): Size of the process pool. Defaults to the number of
+            cores, 1 runs in this process.
+        out: Optional (N, samples) array for the aligned traces.
+
+    Returns:
+        (aligned, shifts): aligned[i, j] = traces[i, j + shifts[i]], zero
+        where that is outside the trace.
+    """
+    ref = np.asarray(ref, dtype=np.float64)
+    return _run(_resync_sad_chunk, traces, (ref, tuple(window), max_shift), chunk, processes, out)
+
+
+def resync_dtw(traces, ref, radius, chunk=64, processes=None, out=None):
+    """Aligns traces to ref with dynamic time warping.
+
+    Like ``cwa.preprocessing.ResyncDTW``, each output sample is the mean of
+    the trace samples the warping path matches to that sample of ref. The
+    path is searched in a band of +-radius samples around the diagonal (an
+    exact DTW within the band). This is not fastdtw's multi-resolution
+    radius: it has to be at least as large as the largest misalignment.
+
+    Args:
+        traces: (N, samples) array, np.memmap or zarr array.
+        ref: Reference trace, (samples,).
+        radius (int): Largest warp, in samples.
+        chunk (int): Traces per task. Uses about chunk * samples * (2 * radius + 1)
+            bytes per worker.
+        processes (int): Size of the process pool. Defaults to the number of
+            cores, 1 runs in this process.
+        out: Optional (N, samples) array for the aligned traces.
+
+    Returns:
+        (aligned, shifts): shifts is the median offset (trace sample - ref
+        sample) along each path, rounded, in the same sense as resync_sad.
+    """
+    ref = np.asarray(ref, dtype=np.float64)
+    if len(ref) != traces.shape[1]:
+        raise ValueError("ref has {} samples, traces have {}".format(len(ref), traces.shape[1]))
+    return _run(_resync_dtw_chunk, traces, (ref, radius), chunk, processes, out)
+
+
+def _synthetic(n, samples, max_shift, seed=0):
+    rng = np.random.RandomState(seed)
+    base = np.convolve(rng.normal(0, 1, samples + 2 * max_shift), np.ones(5) / 5, mode='same')
+    shifts = rng.randint(-max_shift, max_shift + 1, n)
+    traces = np.stack([base[max_shift + s:max_shift + s + samples] for s in shifts])
+    traces += rng.normal(0, 0.05, traces.shape)
+    # trace i is the reference moved right by shifts[i]
+    return traces.astype(np.float32), -shifts, base[max_shift:max_shift + samples]
+
+
+if __name__ == "__main__":
+    import time
+    n, samples = 2000, 5000
+    traces, true_shifts, ref = _synthetic(n, samples, 100)
+
+    start = time.perf_counter()
+    aligned, shifts = resync_sad(traces, ref, (2000, 2300), 150)
+    seconds = time.perf_counter() - start
+    print("SAD: {} x {} traces in {:.2f}s, {:.0f} traces/s, {} wrong shifts".format(
+        n, samples, seconds, n / seconds, np.sum(shifts != true_shifts)))
+
+    n = 500
+    start = time.perf_counter()
+    aligned, shifts = resync_dtw(traces[:n], ref, radius=120)
+    seconds = time.perf_counter() - start
+    print("DTW: {} x {} traces in {:.2f}s, {:.0f} traces/s, {} wrong shifts, residual {:.3f}".format(
+        n, samples, seconds, n / seconds, np.sum(shifts != true_shifts[:n]),
+        np.abs(aligned[:, 200:-200] - ref[200:-200]).mean()))
@@ -0,0 +1,276 @@
+"""Batch key/text generation and vectorized AES-128 verification for TVLA.
+
+The ``cwtvla.ktp`` classes make one key/text pair per call and
+``verify_AES`` runs a pure Python AES for every trace, which costs more
+host time per trace than a fast target takes to encrypt. The classes here
+generate whole batches as ``(N, 16)`` uint8 arrays from a seeded NumPy
+generator, and :func:`verify_AES_batch` checks a batch of ciphertexts with
+a table driven AES-128 that runs on all rows at once.
+
+The fixed keys/texts are the same as in ``cwtvla.ktp``. The random groups
+come from a PCG64 stream per group instead of an AES chain, so a campaign
+is reproducible from ``seed`` and can be restored after ``n`` pairs by
+advancing the stream (see ``getstate()``/``setstate()``, used by
+``campaign.Campaign``).
+
+Basic usage::
+
+    from batch_ktp import BatchFixedVRandomText, verify_AES_batch
+    ktp = BatchFixedVRandomText(seed=1234)
+    keys, texts = ktp.group_B(N) # (N, 16) uint8 each
+    ...
+    ok = verify_AES_batch(texts, keys, textouts) # (N,) bool
+"""
+import numpy as np
+from cwtvla import aes_tables
+
+SBOX = np.array(aes_tables.sbox, dtype='uint8')
+RCON = (0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1B, 0x36)
+XTIME = np.array([((x << 1) ^ (0x1B if x & 0x80 else 0)) & 0xFF for x in range(256)], dtype='uint8')
+# state byte i is row i % 4 of column i // 4, as in cwtvla.aes_cipher
+SHIFT_ROWS = np.array([((i // 4 + i % 4) % 4) * 4 + i % 4 for i in range(16)])
+
+
+def _as_blocks(data, width=16):
+    """Turn a bytearray, list of bytearrays or array into an (N, width) uint8 array."""
+    if isinstance(data, (bytes, bytearray)):
+        data = list(data)
+    data = np.asarray(data, dtype='uint8')
+    if data.ndim == 1:
+        data = data.reshape(1, width)
+    return data
+
+
+def expand_key_128(keys):
+    """Expand (N, 16) AES-128 keys into (N, 11, 16) round keys."""
+    keys = _as_blocks(keys)
+    words = [keys[:, 4 * i:4 * i + 4] for i in range(4)]
+    for rnd in range(10):
+        t = SBOX[words[-1][:, [1, 2, 3, 0]]]
+        t[:, 0] ^= RCON[rnd]
+        for i in range(4):
+            t = words[-4] ^ t
+            words.append(t)
+    return np.concatenate(words, axis=1).reshape(len(keys), 11, 16)
+
+
+def aes128_encrypt(texts, keys):
+    """Encrypt a batch of blocks with AES-128.
+
+    Args:
+        texts: (N, 16) plaintexts.
+        keys: (N, 16) keys, or a single (16,) key used for every block.
+
+    Returns:
+        np.ndarray: (N, 16) uint8 ciphertexts.
+    """
+    state = _as_blocks(texts).copy()
+    round_keys = expand_key_128(keys)
+    state ^= round_keys[:, 0]
+    for rnd in range(1, 11):
+        state = SBOX[state][:, SHIFT_ROWS]
+        if rnd != 10:
+            cols = state.reshape(-1, 4, 4)
+            total = cols[:, :, 0] ^ cols[:, :, 1] ^ cols[:, :, 2] ^ cols[:, :, 3]
+            cols = cols ^ total[:, :, np.newaxis] ^ XTIME[cols ^ np.roll(cols, -1, axis=2)]
+            state = cols.reshape(-1, 16)
+        state ^= round_keys[:, rnd]
+    return state
+
+
+def verify_AES_batch(plaintexts, keys, ciphertexts):
+    """Vectorized ``cwtvla.ktp.verify_AES`` for a batch of traces.
+
+    Args:
+        plaintexts: (N, 16) plaintexts (array or list of bytearrays).
+        keys: (N, key_len) keys or a single key. Only AES-128 is vectorized,
+            longer keys are checked one at a time with ``verify_AES``.
+        ciphertexts: (N, 16) ciphertexts returned by the target.
+
+    Returns:
+        np.ndarray: (N,) bool, True where the ciphertext is correct.
+    """
+    plaintexts = _as_blocks(plaintexts)
+    ciphertexts = _as_blocks(ciphertexts)
+    keys = np.asarray(list(keys) if isinstance(keys, (bytes, bytearray)) else keys, dtype='uint8')
+    if keys.shape[-1] != 16:
+        from cwtvla.ktp import verify_AES
+        keys = np.broadcast_to(keys, (len(plaintexts), keys.shape[-1]))
+        return np.array([verify_AES(bytearray(p), bytearray(k), bytearray(c))
+                         for p, k, c in zip(plaintexts, keys, ciphertexts)], dtype=bool)
+    return (aes128_encrypt(plaintexts, keys) == ciphertexts).all(axis=1)
+
+
+_FIXED = {
+    16: ("da 39 a3 ee 5e 6b 4b 0d 32 55 bf ef 95 60 18 90",
+         "01 23 45 67 89 ab cd ef 12 34 56 78 9a bc de f0",
+         "81 1E 37 31 B0 12 0A 78 42 78 1E 22 B2 5C DD F9"),
+    24: ("da 39 a3 ee 5e 6b 4b 0d 32 55 bf ef 95 60 18 88",
+         "01 23 45 67 89 ab cd ef 12 34 56 78 9a bc de f0 23 45 67 89 ab cd ef 01",
+         "81 1E 37 31 B0 12 0A 78 42 78 1E 22 B2 5C DD F9 94 F4 D9 2C D2 FA E6 45"),
+    32: ("da 39 a3 ee 5e 6b 4b 0d 32 55 bf ef 95 60 18 95",
+         "01 23 45 67 89 ab cd ef 12 34 56 78 9a bc de f0 23 45 67 89 ab cd ef 01 34 56 78 9a bc de f0 12",
+         "81 1E 37 31 B0 12 0A 78 42 78 1E 22 B2 5C DD F9 94 F4 D9 2C D2 FA E6 45 37 B9 40 EA 5E 1A F1 12"),
+}
+
+
+class _BatchKTP:
+    """Base class: one reproducible random stream per group.
+
+    Subclasses set ``_words`` (64 bit words per pair, per group) and
+    implement ``_make(group, data)`` turning raw bytes into (keys, texts).
+    """
+    _words = (2, 2)
+
+    def __init__(self, key_len=16, seed=None, buffer=1024):
+        if key_len not in _FIXED:
+            raise ValueError("Invalid key length {}, must be 16, 24, or 32".format(key_len))
+        self._key_len = key_len
+        fixed_text, dev_key, fixed_key = _FIXED[key_len]
+        self._I_fixed = np.array(bytearray.fromhex(fixed_text), dtype='uint8')
+        self._K_dev = np.array(bytearray.fromhex(dev_key), dtype='uint8')
+        self._K_fixed = np.array(bytearray.fromhex(fixed_key), dtype='uint8')
+        # the entropy is kept so the campaign can be regenerated later
+        self.seed = np.random.SeedSequence(seed).entropy
+        self._buffer_size = buffer
+        self.setstate({'seed': self.seed, 'counts': [0, 0]})
+
+    def getstate(self):
+        """JSON serializable state: the seed and the pairs used from each group."""
+        return {'seed': self.seed, 'counts': list(self._counts)}
+
+    def setstate(self, state):
+        self.seed = state['seed']
+        self._counts = list(state['counts'])
+        self._streams = [np.random.PCG64(s) for s in np.random.SeedSequence(self.seed).spawn(2)]
+        for group, stream in enumerate(self._streams):
+            stream.advance(self._counts[group] * self._words[group])
+        self._buffers = [None, None]
+        self._pos = [0, 0]
+
+    def _draw(self, group, n):
+        raw = self._streams[group].random_raw(n * self._words[group]).astype('<u8')
+        return self._make(group, raw.view('uint8').reshape(n, 8 * self._words[group]))
+
+    def _group(self, group, n):
+        # pairs already handed out one at a time must not be repeated
+        keys, texts = [], []
+        if self._buffers[group] is not None:
+            k, t = self._buffers[group]
+            take = min(n, len(t) - self._pos[group])
+            keys.append(k[self._pos[group]:self._pos[group] + take])
+            texts.append(t[self._pos[group]:self._pos[group] + take])
+            self._pos[group] += take
+            self._counts[group] += take
+            n -= take
+        if n or not texts:
+            k, t = self._draw(group, n)
+            keys.append(k)
+            texts.append(t)
+            self._counts[group] += n
+        return np.concatenate(keys), np.concatenate(texts)
+
+    def group_A(self, n):
+        """Return (keys, texts) for the next n group A traces as uint8 arrays."""
+        return self._group(0, n)
+
+    def group_B(self, n):
+        """Return (keys, texts) for the next n group B traces as uint8 arrays."""
+        return self._group(1, n)
+
+    def _next(self, group):
+        buf = self._buffers[group]
+        if buf is None or self._pos[group] == len(buf[1]):
+            # draw without counting, _counts only tracks pairs actually handed out
+            self._buffers[group] = self._draw(group, self._buffer_size)
+            self._pos[group] = 0
+            buf = self._buffers[group]
+        i = self._pos[group]
+        self._pos[group] += 1
+        self._counts[group] += 1
+        return bytearray(buf[0][i]), bytearray(buf[1][i])
+
+    def next_group_A(self):
+        """Drop-in for ``cwtvla.ktp``: return the next group A key, text as bytearrays."""
+        return self._next(0)
+
+    def next_group_B(self):
+        """Drop-in for ``cwtvla.ktp``: return the next group B key, text as bytearrays."""
+        return self._next(1)
+
+
+class BatchFixedVRandomText(_BatchKTP):
+    """Batch version of ``cwtvla.ktp.FixedVRandomText``.
+
+    Group A is the fixed key and fixed text, group B the fixed key with random
+    texts. ``group_B`` can also be used for random v random captures.
+
+    Args:
+        key_len (int): 16, 24 or 32 byte key.
+        seed (int): Seed of the random texts. A fresh one (kept in ``seed``) if None.
+        buffer (int): Pairs generated at a time by ``next_group_A/B``.
+    """
+    _name = "FixedVRandomText"
+    _words = (0, 2)
+
+    def _make(self, group, data):
+        n = len(data)
+        keys = np.tile(self._K_dev, (n, 1))
+        if group == 0:
+            return keys, np.tile(self._I_fixed, (n, 1))
+        return keys, data
+
+
+class BatchFixedVRandomKey(_BatchKTP):
+    """Batch version of ``cwtvla.ktp.FixedVRandomKey``.
+
+    Group A is the fixed key with random texts, group B random keys with
+    random texts.
+
+    Args:
+        key_len (int): 16, 24 or 32 byte key.
+        seed (int): Seed of the random keys/texts. A fresh one (kept in ``seed``) if None.
+        buffer (int): Pairs generated at a time by ``next_group_A/B``.
+    """
+    _name = "FixedVRandomKey"
+
+    def __init__(self, key_len=16, seed=None, buffer=1024):
+        self._words = (2, 2 + key_len // 8)
+        super().__init__(key_len, seed, buffer)
+
+    def _make(self, group, data):
+        if group == 0:
+            return np.tile(self._K_fixed, (len(data), 1)), data
+        return data[:, 16:].copy(), data[:, :16].copy()
+
+
+def benchmark(n=10000):
+    """Time verify_AES on n traces against verify_AES_batch.
+
+    Returns:
+        dict: traces/second for ``verify_AES`` and ``verify_AES_batch``.
+    """
+    import time
+    from cwtvla.ktp import verify_AES
+    ktp = BatchFixedVRandomKey(seed=0)
+    keys, texts = ktp.group_B(n)
+    textouts = aes128_encrypt(texts, keys)
+    pairs = [(bytearray(t), bytearray(k), bytearray(c)) for t, k, c in zip(texts, keys, textouts)]
+
+    start = time.perf_counter()
+    if not all(verify_AES(t, k, c) for t, k, c in pairs):
+        raise ValueError("aes128_encrypt doesn't match cwtvla")
+    serial = n / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if not verify_AES_batch(texts, keys, textouts).all():
+        raise ValueError("verify_AES_batch failed")
+    batch = n / (time.perf_counter() - start)
+    return {'verify_AES': serial, 'verify_AES_batch': batch}
+
+
+if __name__ == "__main__":
+    result = benchmark()
+    print("verify_AES:       {:10.1f} traces/s".format(result['verify_AES']))
+    print("verify_AES_batch: {:10.1f} traces/s ({:.0f}x)".format(
+        result['verify_AES_batch'], result['verify_AES_batch'] / result['verify_AES']))
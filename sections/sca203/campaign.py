@@ -0,0 +1,158 @@
+"""Resumable, crash-safe capture campaigns stored in zarr.
+
+Captured rows are appended to the store one chunk at a time. After every
+chunk has been written, the number of committed traces (the cursor) and the
+state of the key text pattern generator are saved in the store's attrs. If
+the capture is interrupted, creating the campaign again with the same path
+restores the generator and continues from the last committed chunk, so at
+most one chunk of traces has to be re-captured.
+
+Basic usage::
+
+    from campaign import Campaign
+    campaign = Campaign('data/rvr.zarr', ktp, N)
+    if campaign.cursor == 0:
+        # nothing committed yet (new, or crashed within the first chunk)
+        create_traces(campaign.root, 'traces/waves', (N, scope.adc.samples), overwrite=True)
+        campaign.root.zeros('traces/textins', shape=(N, 16), chunks=(2500, None), dtype='uint8', overwrite=True)
+
+    def capture(i):
+        key, text = ktp.next_group_B()
+        trace = capture_trace(scope, target, text, key)
+        return {'traces/waves': trace.wave, 'traces/textins': text}
+
+    campaign.run(capture, ['traces/waves', 'traces/textins'])
+"""
+import numpy as np
+import zarr
+
+from capture_pipeline import CapturePipeline, ChunkWriter
+from trace_store import encoder
+
+
+def ktp_state(ktp):
+    """Return the JSON serializable state of a key text pattern object.
+
+    Uses ``ktp.getstate()`` if there is one. Otherwise all bytearray and integer
+    attributes are saved, which covers the ``cwtvla.ktp`` classes (their
+    sequences are AES chains started from a bytearray or a counter).
+    """
+    if hasattr(ktp, 'getstate'):
+        return ktp.getstate()
+    state = {}
+    for name, value in vars(ktp).items():
+        if isinstance(value, (bytes, bytearray)):
+            state[name] = {'type': type(value).__name__, 'hex': value.hex()}
+        elif isinstance(value, np.integer):
+            state[name] = {'type': np.dtype(type(value)).name, 'value': int(value)}
+        elif isinstance(value, int) and not isinstance(value, bool):
+            state[name] = {'type': 'int', 'value': value}
+    return state
+
+
+def set_ktp_state(ktp, state):
+    """Restore state returned by :func:`ktp_state`."""
+    if hasattr(ktp, 'setstate'):
+        ktp.setstate(state)
+        return
+    for name, value in state.items():
+        if value['type'] == 'bytearray':
+            value = bytearray.fromhex(value['hex'])
+        elif value['type'] == 'bytes':
+            value = bytes.fromhex(value['hex'])
+        elif value['type'] == 'int':
+            value = value['value']
+        else:
+            value = np.dtype(value['type']).type(value['value'])
+        setattr(ktp, name, value)
+
+
+class Campaign:
+    """Capture campaign that can be resumed after a crash.
+
+    Args:
+        path (str): Path of the zarr DirectoryStore.
+        ktp: Key text pattern object used by the capture function. Its state
+            is saved with every chunk and restored when resuming.
+        n (int): Total number of traces in the campaign.
+        resume (bool): Continue an existing campaign at path if there is one.
+            If False (or there isn't one), the store is overwritten.
+    """
+    def __init__(self, path, ktp, n, resume=True):
+        self.path = path
+        self.ktp = ktp
+        self.n = n
+        info = None
+        if resume:
+            try:
+                info = zarr.open_group(path, mode='r').attrs.get('campaign')
+            except (ValueError, KeyError, zarr.errors.GroupNotFoundError):
+                info = None
+        if info:
+            if info['n'] != n:
+                raise ValueError("Campaign at {} is for {} traces, not {}".format(path, info['n'], n))
+            self.root = zarr.open_group(path, mode='r+')
+            set_ktp_state(ktp, info['ktp_state'])
+            self.cursor = info['cursor']
+        else:
+            self.root = zarr.group(store=zarr.DirectoryStore(path), overwrite=True)
+            self.cursor = 0
+            self._commit(0, ktp_state(ktp))
+
+    @property
+    def done(self):
+        return self.cursor >= self.n
+
+    def _commit(self, cursor, state):
+        # chunks are already on disk at this point, so the cursor never runs ahead of the data
+        self.root.attrs['campaign'] = {'n': self.n, 'cursor': cursor, 'ktp': type(self.ktp).__name__,
+                                       'ktp_state': state}
+        self.cursor = cursor
+
+    def run(self, capture, arrays, process=None, progress=None, maxsize=32):
+        """Capture the remaining traces.
+
+        Args:
+            capture (callable): ``capture(i)`` returns a dict of {array name: row}
+                for trace i. Runs in the capture thread of a CapturePipeline.
+            arrays (list): Names of the arrays in the store the rows go to. They
+                must have the same number of rows per chunk.
+            process (callable): Optional ``process(i, rows)`` run before the rows
+                are stored, e.g. to verify the encryption or update a t-test.
+            progress (callable): Optional, called with the number of traces done.
+
+        Returns:
+            dict: Pipeline statistics, see ``CapturePipeline.run``.
+        """
+        rows = self.root[arrays[0]].chunks[0]
+        for name in arrays:
+            if self.root[name].chunks[0] != rows:
+                raise ValueError("All campaign arrays need the same chunk size, {} has {} rows not {}".format(
+                    name, self.root[name].chunks[0], rows))
+        # resuming always starts on a chunk boundary, so every flush writes exactly one chunk
+        writers = {name: ChunkWriter(self.root[name], start=self.cursor, rows=rows,
+                                     convert=encoder(self.root[name])) for name in arrays}
+        start = self.cursor
+
+        def capture_row(i):
+            i += start
+            row = capture(i)
+            state = None
+            if (i + 1) % rows == 0 or i + 1 == self.n:
+                # state has to be taken here: the capture thread runs ahead of the writer
+                state = ktp_state(self.ktp)
+            return row, state
+
+        def process_row(i, item):
+            i += start
+            row, state = item
+            if process:
+                process(i, row)
+            for name in arrays:
+                writers[name].append(row[name])
+            if state is not None:
+                for writer in writers.values():
+                    writer.flush()
+                self._commit(i + 1, state)
+
+        return CapturePipeline(capture_row, process_row, maxsize).run(self.n - start, progress)
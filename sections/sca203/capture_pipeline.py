@@ -0,0 +1,268 @@
+"""Double-buffered capture pipeline for long TVLA campaigns.
+
+A plain capture loop does arm -> capture -> readout -> verify -> store for
+every trace, so the scope sits idle while the host verifies the encryption
+and writes to disk. ``CapturePipeline`` runs the scope side (arm/readout) in a
+producer thread and the host side (AES verification, dtype conversion,
+chunked zarr writes) in a consumer thread, joined by a bounded queue. Both
+USB transfers and zarr/Blosc writes release the GIL, so the host side work
+overlaps with the next acquisition.
+
+Basic usage::
+
+    from capture_pipeline import CapturePipeline, ChunkWriter, capture_trace
+
+    waves = ChunkWriter(zwaves)
+    def capture(i):
+        key, text = ktp.next_group_B()
+        return key, text, capture_trace(scope, target, text, key)
+
+    def process(i, item):
+        key, text, trace = item
+        if not verify_AES(text, key, trace.textout):
+            raise ValueError("Encryption failed")
+        waves.append(trace.wave)
+
+    stats = CapturePipeline(capture, process).run(N)
+    waves.flush()
+"""
+import queue
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+_DONE = object()
+
+
+def capture_trace(scope, target, text, key, retries=None):
+    """``cw.capture_trace`` that retries until a trace is actually captured.
+
+    Args:
+        retries (int): Give up and raise IOError after this many failed
+            captures. Retries forever if None, like the original loops.
+    """
+    import chipwhisperer as cw
+    tries = 0
+    trace = cw.capture_trace(scope, target, text, key)
+    while trace is None:
+        tries += 1
+        if retries is not None and tries >= retries:
+            raise IOError("Capture failed {} times in a row".format(tries))
+        trace = cw.capture_trace(scope, target, text, key)
+    return trace
+
+
+class ChunkWriter:
+    """Buffers rows and writes them to a zarr (or numpy) array one chunk at a time.
+
+    Writing single rows into a zarr array rewrites (and recompresses) the whole
+    chunk every time, so rows are collected into a chunk sized buffer first.
+    Without ``convert`` the buffer has the array's dtype, so conversion happens on append.
+
+    Args:
+        array: Destination array. Needs ``shape``, ``dtype`` and slice assignment.
+        start (int): First row to write to.
+        rows (int): Rows per flush. Defaults to the array's chunk size.
+        convert (callable): Optional, applied to each buffer before it's
+            written, e.g. ``trace_store.encoder(array)`` for raw ADC code arrays.
+    """
+    def __init__(self, array, start=0, rows=None, convert=None):
+        self.array = array
+        self.convert = convert
+        if rows is None:
+            rows = getattr(array, 'chunks', (1024,))[0]
+        self.rows = rows
+        self.position = start
+        # keep full precision until convert() has seen the data
+        dtype = 'float64' if convert else array.dtype
+        self._buffer = np.zeros((rows,) + tuple(array.shape[1:]), dtype=dtype)
+        self._fill = 0
+
+    def append(self, row):
+        self._buffer[self._fill] = row
+        self._fill += 1
+        if self._fill == self.rows:
+            self.flush()
+
+    def flush(self):
+        """Write out any buffered rows. Returns the next row to be written."""
+        if self._fill:
+            data = self._buffer[:self._fill]
+            if self.convert:
+                data = self.convert(data)
+            self.array[self.position:self.position + self._fill] = data
+            self.position += self._fill
+            self._fill = 0
+        return self.position
+
+
+class CapturePipeline:
+    """Producer/consumer pipeline overlapping acquisition with host processing.
+
+    Args:
+        capture (callable): ``capture(i)`` runs in the producer thread and
+            returns the item for capture index i (e.g. ``(key, text, trace)``).
+        process (callable): ``process(i, item)`` runs in the consumer thread,
+            in capture order. Exceptions raised here stop the pipeline and are
+            re-raised from ``run()``.
+        maxsize (int): Number of captured items that can be waiting for the
+            consumer before the producer blocks.
+    """
+    def __init__(self, capture, process, maxsize=32):
+        self.capture = capture
+        self.process = process
+        self.maxsize = maxsize
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Stop capturing after the current trace. Safe to call from ``process``."""
+        self._stop.set()
+
+    def run(self, n, progress=None):
+        """Capture and process n items.
+
+        Args:
+            n (int): Number of items to capture.
+            progress (callable): Optional, called with the number of items
+                processed so far, e.g. ``tqdm.update``.
+
+        Returns:
+            dict: ``captured``, ``processed``, ``seconds`` and ``traces_per_second``.
+        """
+        self._stop.clear()
+        q = queue.Queue(self.maxsize)
+        errors = []
+        counts = {'captured': 0, 'processed': 0}
+
+        def put(item):
+            # don't block forever if the consumer died
+            while not self._stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def producer():
+            try:
+                for i in range(n):
+                    if self._stop.is_set():
+                        break
+                    if not put((i, self.capture(i))):
+                        break
+                    counts['captured'] += 1
+            except BaseException as e:
+                errors.append(e)
+                self._stop.set()
+            finally:
+                q.put(_DONE)
+
+        start = time.perf_counter()
+        thread = threading.Thread(target=producer, name="capture-producer", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is _DONE:
+                    break
+                if errors:
+                    continue
+                self.process(*item)
+                counts['processed'] += 1
+                if progress:
+                    progress(1)
+        except BaseException:
+            self._stop.set()
+            # unblock the producer so the thread can exit
+            while thread.is_alive():
+                try:
+                    q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise
+        finally:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        seconds = time.perf_counter() - start
+        counts['seconds'] = seconds
+        counts['traces_per_second'] = counts['processed'] / seconds if seconds else 0
+        return counts
+
+
+Trace = namedtuple('Trace', ['wave', 'textin', 'textout', 'key'])
+
+
+class SimulatedCapture:
+    """Stand-in for ``capture_trace`` with a fixed acquisition time.
+
+    Each call takes ``acq_time`` seconds in total (most of it sleeping, like a
+    real scope readout waiting on USB), and returns a trace with a correct
+    AES ciphertext so host side verification can be benchmarked too.
+
+    Args:
+        samples (int): Samples per trace.
+        acq_time (float): Seconds per capture.
+    """
+    def __init__(self, samples=5000, acq_time=0.005, seed=0):
+        self.samples = samples
+        self.acq_time = acq_time
+        self._rng = np.random.default_rng(seed)
+
+    def __call__(self, text, key):
+        from cwtvla.ktp import _expand_aes_key
+        from cwtvla.aes_cipher import AESCipher
+        start = time.perf_counter()
+        textout = bytearray(AESCipher(_expand_aes_key(key)).cipher_block(list(text)))
+        wave = self._rng.integers(-512, 512, self.samples) / 1024
+        remaining = self.acq_time - (time.perf_counter() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+        return Trace(wave, text, textout, key)
+
+
+def benchmark(n=500, samples=5000, acq_time=0.005, maxsize=32):
+    """Compare the serial capture loop against CapturePipeline on SimulatedCapture.
+
+    Returns:
+        dict: traces/second for ``serial`` and ``pipelined`` capture.
+    """
+    from cwtvla.ktp import FixedVRandomText, verify_AES
+
+    def make(num):
+        sim = SimulatedCapture(samples, acq_time)
+        ktp = FixedVRandomText(16)
+        waves = ChunkWriter(np.zeros((num, samples), dtype='float32'), rows=256)
+
+        def capture(i):
+            key, text = ktp.next_group_B()
+            return key, text, sim(text, key)
+
+        def process(i, item):
+            key, text, trace = item
+            if not verify_AES(text, key, trace.textout):
+                raise ValueError("Encryption failed")
+            waves.append(trace.wave)
+        return capture, process, waves
+
+    capture, process, waves = make(n)
+    start = time.perf_counter()
+    for i in range(n):
+        process(i, capture(i))
+    waves.flush()
+    serial = n / (time.perf_counter() - start)
+
+    capture, process, waves = make(n)
+    pipelined = CapturePipeline(capture, process, maxsize).run(n)['traces_per_second']
+    waves.flush()
+    return {'serial': serial, 'pipelined': pipelined}
+
+
+if __name__ == "__main__":
+    result = benchmark()
+    print("serial:    {:8.1f} traces/s".format(result['serial']))
+    print("pipelined: {:8.1f} traces/s ({:.2f}x)".format(result['pipelined'], result['pipelined'] / result['serial']))
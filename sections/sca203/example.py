@@ -1,7 +1,6 @@
 # do capture for TVLA
 
 #... setup, get scope, target
-from tqmd import trange
 import chipwhisperer as cw
 scope = cw.scope()
 target = cw.target(scope)
@@ -11,36 +10,39 @@ scope.default_setup()
 N = 50000 #total traces = 2*n
 
 from cwtvla.ktp import FixedVRandomText, verify_AES
+from online_ttest import TVLATTest
 import numpy as np
 key_len = 16
 ktp = FixedVRandomText(key_len)
 
-group1 = np.zeros((N, scope.adc.samples), dtype='float64')
-group2 = np.zeros((N, scope.adc.samples), dtype='float64')
-for i in trange(N):
-    key, text = ktp.next_group_A()
+# streaming t-test, so only O(samples) memory is needed instead of 2 (N, samples) arrays
+acc = TVLATTest(scope.adc.samples)
 
-    trace = cw.capture_trace(scope, target, text, key)
-    while trace is None:
-        trace = cw.capture_trace(scope, target, text, key)
+# scope arm/readout runs in one thread, AES verification and the t-test in another
+from capture_pipeline import CapturePipeline, capture_trace
+def capture(i):
+    key_a, text_a = ktp.next_group_A()
+    trace_a = capture_trace(scope, target, text_a, key_a)
+    key_b, text_b = ktp.next_group_B()
+    trace_b = capture_trace(scope, target, text_b, key_b)
+    return (key_a, text_a, trace_a), (key_b, text_b, trace_b)
 
-    if not verify_AES(text, key, trace.textout):
-        raise ValueError("Encryption failed")
-    group1[i,:] = trace.wave[:]
+def process(i, item):
+    for group, (key, text, trace) in enumerate(item):
+        if not verify_AES(text, key, trace.textout):
+            raise ValueError("Encryption failed")
+        acc.add(group, trace.wave)
 
-    key, text = ktp.next_group_B() 
-    trace = cw.capture_trace(scope, target, text, key)
-    while trace is None:
-        trace = cw.capture_trace(scope, target, text, key)
+    # stop as soon as both t-tests agree there's leakage
+    if (i + 1) % 1000 == 0 and acc.failed():
+        pipeline.stop()
 
-    group2[i,:] = trace.wave[:]
-    if not verify_AES(text, key, trace.textout):
-        raise ValueError("Encryption failed")
+pipeline = CapturePipeline(capture, process)
+pipeline.run(N)
 
 # do analysis
-from cwtvla.analysis import t_test, check_t_test
-t_val = t_test(group1, group2)
-fp = check_t_test(t_val)
+t_val = acc.t_value()
+fp = acc.check()
 
 if len(fp) > 0:
     print("Failed T Test @ {}".format(fp))
@@ -62,18 +64,20 @@ ktp = FixedVRandomText(key_len)
 waves = np.zeros((N, scope.adc.samples), dtype='float64')
 textins = np.zeros((N, 16), dtype='uint8')
 
-for i in trange(N):
+def capture(i):
     key, text = ktp.next_group_B()
-    trace = cw.capture_trace(scope, target, text, key)
-    while trace is None:
-        trace = cw.capture_trace(scope, target, text, key)
+    return key, text, capture_trace(scope, target, text, key)
 
+def process(i, item):
+    key, text, trace = item
     if not verify_AES(text, key, trace.textout):
         raise ValueError("Encryption failed")
     #project.traces.append(trace)
     waves[i, :] = trace.wave
     textins[i, :] = np.array(text)
 
+CapturePipeline(capture, process).run(N)
+
 ## test rand_v_rand
 from cwtvla.analysis import eval_rand_v_rand, roundinout_hd
 
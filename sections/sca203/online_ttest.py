@@ -0,0 +1,290 @@
+"""One-pass (streaming) Welch t-test for TVLA captures.
+
+The accumulators here keep running central moments instead of the traces
+themselves, so a TVLA campaign only needs O(samples) memory no matter how
+many traces are captured. Moments are combined with the pairwise update
+formulas from Pebay (2008), which means partial accumulators (e.g. from
+different chunks, processes or capture machines) can be merged exactly.
+
+Basic usage::
+
+    from online_ttest import TVLATTest
+    acc = TVLATTest(scope.adc.samples)
+    for i in trange(N):
+        key, text = ktp.next_group_A()
+        acc.add(0, cw.capture_trace(scope, target, text, key).wave)
+        key, text = ktp.next_group_B()
+        acc.add(1, cw.capture_trace(scope, target, text, key).wave)
+        if i % 1000 == 999 and acc.failed():
+            break # leakage already confirmed, no need to keep capturing
+    t = acc.t_value()
+"""
+import numpy as np
+
+
+class Moments:
+    """Running mean and central moment sums (up to 4th order) of a set of traces.
+
+    Args:
+        samples (int): Number of samples per trace.
+        order (int): Highest t-test order that will be requested (1 or 2).
+            First order only needs the 2nd central moment, second order needs
+            up to the 4th.
+    """
+    def __init__(self, samples, order=1):
+        if order not in (1, 2):
+            raise ValueError("Only first and second order moments are supported, not {}".format(order))
+        self.order = order
+        self.n = 0
+        self.mean = np.zeros(samples, dtype='float64')
+        self.m2 = np.zeros(samples, dtype='float64')
+        if order > 1:
+            self.m3 = np.zeros(samples, dtype='float64')
+            self.m4 = np.zeros(samples, dtype='float64')
+
+    def update(self, traces):
+        """Add a single trace (1D) or a batch of traces (2D, one per row)."""
+        traces = np.asarray(traces, dtype='float64')
+        if traces.ndim == 1:
+            traces = traces[np.newaxis, :]
+        if len(traces) == 0:
+            return
+
+        n_b = len(traces)
+        mean_b = traces.mean(axis=0)
+        if n_b == 1:
+            self._combine(n_b, mean_b, 0, 0, 0)
+            return
+
+        d = traces - mean_b
+        d2 = d * d
+        m2_b = d2.sum(axis=0)
+        m3_b = m4_b = 0
+        if self.order > 1:
+            m3_b = (d2 * d).sum(axis=0)
+            m4_b = (d2 * d2).sum(axis=0)
+        self._combine(n_b, mean_b, m2_b, m3_b, m4_b)
+
+    def merge(self, other):
+        """Merge the moments of another accumulator into this one."""
+        if other.order < self.order:
+            raise ValueError("Cannot merge order {} moments into order {} moments".format(other.order, self.order))
+        if other.n == 0:
+            return
+        if self.order > 1:
+            self._combine(other.n, other.mean, other.m2, other.m3, other.m4)
+        else:
+            self._combine(other.n, other.mean, other.m2, 0, 0)
+
+    def _combine(self, n_b, mean_b, m2_b, m3_b, m4_b):
+        n_a = self.n
+        if n_a == 0:
+            self.n = n_b
+            self.mean = np.array(mean_b, dtype='float64')
+            self.m2 = self.m2 + m2_b
+            if self.order > 1:
+                self.m3 = self.m3 + m3_b
+                self.m4 = self.m4 + m4_b
+            return
+
+        n = n_a + n_b
+        delta = mean_b - self.mean
+        delta_n = delta * (n_b / n)
+        if self.order > 1:
+            # must use the old m2/m3 values, so these go first
+            delta2 = delta * delta
+            self.m4 = self.m4 + m4_b \
+                + delta2 * delta2 * (n_a * n_b * (n_a * n_a - n_a * n_b + n_b * n_b) / n**3) \
+                + 6 * delta2 * (n_a * n_a * m2_b + n_b * n_b * self.m2) / (n * n) \
+                + 4 * delta * (n_a * m3_b - n_b * self.m3) / n
+            self.m3 = self.m3 + m3_b \
+                + delta2 * delta * (n_a * n_b * (n_a - n_b) / (n * n)) \
+                + 3 * delta * (n_a * m2_b - n_b * self.m2) / n
+        self.m2 = self.m2 + m2_b + delta * delta_n * n_a
+        self.mean = self.mean + delta_n
+        self.n = n
+
+    def statistic(self, order=1):
+        """Return the (mean, variance) of the order-th preprocessed traces.
+
+        For order 1 these are the sample mean and unbiased variance of the
+        traces. For order 2 they are the mean and variance of the centered
+        squared traces, (x - mean)**2, as used for second order univariate TVLA.
+        """
+        if order > self.order:
+            raise ValueError("Accumulator only tracks moments up to order {}".format(self.order))
+        if order == 1:
+            return self.mean, self.m2 / (self.n - 1)
+        cm2 = self.m2 / self.n
+        cm4 = self.m4 / self.n
+        return cm2, cm4 - cm2 * cm2
+
+
+class WelchTTest:
+    """Mergeable one-pass Welch t-test between two groups of traces.
+
+    Args:
+        samples (int): Number of samples per trace.
+        order (int): Highest t-test order that will be requested (1 or 2).
+    """
+    def __init__(self, samples, order=1):
+        self.samples = samples
+        self.order = order
+        self.groups = [Moments(samples, order), Moments(samples, order)]
+
+    def add(self, group, traces):
+        """Add a trace or batch of traces to group 0 or group 1."""
+        self.groups[group].update(traces)
+
+    def merge(self, other):
+        """Merge another WelchTTest (e.g. from a different chunk) into this one."""
+        for mine, theirs in zip(self.groups, other.groups):
+            mine.merge(theirs)
+
+    @property
+    def counts(self):
+        return self.groups[0].n, self.groups[1].n
+
+    def t_value(self, order=1):
+        """Return Welch's t statistic for every sample point.
+
+        Matches ``scipy.stats.ttest_ind(..., equal_var=False)`` for order 1.
+        Points where both groups have zero variance are returned as 0.
+        """
+        a, b = self.groups
+        if a.n < 2 or b.n < 2:
+            return np.zeros(self.samples, dtype='float64')
+        mean_a, var_a = a.statistic(order)
+        mean_b, var_b = b.statistic(order)
+        den = np.sqrt(var_a / a.n + var_b / b.n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (mean_a - mean_b) / den
+        t[den == 0] = 0
+        return t
+
+
+class TVLATTest:
+    """Streaming replacement for ``cwtvla.analysis.t_test`` on two capture groups.
+
+    TVLA requires two independent t-tests on disjoint halves of the data. As
+    the total number of traces isn't known up front when stopping early, each
+    group's traces are interleaved between the two tests (even/odd capture
+    index) instead of being split into first and second half. This keeps both
+    tests the same size at every point of the capture.
+
+    Args:
+        samples (int): Number of samples per trace.
+        order (int): Highest t-test order that will be requested (1 or 2).
+    """
+    def __init__(self, samples, order=1):
+        self.samples = samples
+        self.order = order
+        self.tests = [WelchTTest(samples, order), WelchTTest(samples, order)]
+        self._next = [0, 0]
+
+    def add(self, group, traces):
+        """Add a trace or a batch of traces (one per row) to group 0 or group 1."""
+        traces = np.asarray(traces)
+        if traces.ndim == 1:
+            self.tests[self._next[group] % 2].add(group, traces)
+            self._next[group] += 1
+            return
+        start = self._next[group] % 2
+        self.tests[start].add(group, traces[0::2])
+        self.tests[1 - start].add(group, traces[1::2])
+        self._next[group] += len(traces)
+
+    def merge(self, other):
+        """Merge another TVLATTest into this one."""
+        for mine, theirs in zip(self.tests, other.tests):
+            mine.merge(theirs)
+        for group in range(2):
+            self._next[group] += other._next[group]
+
+    @property
+    def counts(self):
+        """Number of traces added to (group 0, group 1)."""
+        return tuple(self._next)
+
+    def t_value(self, order=1):
+        """Return a (2, samples) array of t values, as ``cwtvla.analysis.t_test`` does."""
+        return np.array([test.t_value(order) for test in self.tests])
+
+    def check(self, threshold=4.5, order=1):
+        """Return the points where both t-tests exceed threshold with the same sign.
+
+        Same semantics as ``cwtvla.analysis.check_t_test``.
+        """
+        t = self.t_value(order)
+        failed = ((t[0] > threshold) & (t[1] > threshold)) | ((t[0] < -threshold) & (t[1] < -threshold))
+        return np.nonzero(failed)[0].tolist()
+
+    def failed(self, threshold=4.5, order=1):
+        """True once leakage is confirmed by both t-tests at any point."""
+        return len(self.check(threshold, order)) > 0
+
+
+def _chunk_moments(path, name, start, stop, order):
+    """Moments of rows [start, stop) of a zarr array, split by even/odd global row."""
+    import zarr
+    data = zarr.open(path, mode='r')[name][start:stop]
+    samples = data.shape[1]
+    halves = []
+    for parity in (0, 1):
+        m = Moments(samples, order)
+        # keep the same interleaving as TVLATTest.add()
+        m.update(data[(parity - start) % 2::2])
+        halves.append(m)
+    return halves
+
+
+def t_test_zarr(path, group1='traces/group1', group2='traces/group2', order=1, processes=None, output='analysis'):
+    """Chunked, parallel t-test over two trace arrays in a zarr store.
+
+    Each chunk of rows is reduced to partial moments in a worker process and
+    the partial results are merged, so the traces never have to fit in RAM.
+    Use ``processes=1`` to run in the calling process (e.g. for debugging).
+    Raw ADC code arrays (see ``trace_store``) can be used directly, as the
+    t statistic doesn't change under the linear code -> float conversion.
+
+    Args:
+        path (str): Path of the zarr store.
+        group1 (str): Name of the first trace group array in the store.
+        group2 (str): Name of the second trace group array in the store.
+        order (int): t-test order (1 or 2).
+        processes (int): Size of the process pool. Defaults to the number of cores.
+        output (str): Group the t-values are written back to as ``t_order<order>``.
+            Set to None to not modify the store.
+
+    Returns:
+        TVLATTest: Accumulator with all traces merged in. Use ``t_value(order)``
+        to get the (2, samples) t-values.
+    """
+    import zarr
+    root = zarr.open(path, mode='r')
+    jobs = []
+    for group, name in enumerate((group1, group2)):
+        arr = root[name]
+        step = arr.chunks[0]
+        for start in range(0, arr.shape[0], step):
+            jobs.append((group, (path, name, start, min(start + step, arr.shape[0]), order)))
+    acc = TVLATTest(root[group1].shape[1], order)
+
+    if processes == 1:
+        results = [_chunk_moments(*args) for _, args in jobs]
+    else:
+        from multiprocessing.pool import Pool
+        with Pool(processes) as pool:
+            results = pool.starmap(_chunk_moments, [args for _, args in jobs])
+
+    for (group, args), halves in zip(jobs, results):
+        for test, moments in zip(acc.tests, halves):
+            test.groups[group].merge(moments)
+        acc._next[group] += args[3] - args[2]
+
+    if output:
+        out = zarr.open(path, mode='r+').require_group(output)
+        t = out.array('t_order{}'.format(order), acc.t_value(order), overwrite=True)
+        t.attrs['groups'] = [group1, group2]
+        t.attrs['counts'] = list(acc.counts)
+    return acc
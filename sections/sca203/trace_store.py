@@ -0,0 +1,129 @@
+"""Compact zarr storage for captured traces.
+
+ChipWhisperer returns traces as float64 in [-0.5, 0.5), but they're really
+10 bit (12 bit on Husky) ADC codes. Storing the codes as uint16 with a
+scale/offset in the array's attrs and compressing with Blosc/Zstd cuts the
+size of a trace store by 4-8x. ``TraceReader`` turns the codes back into
+floats a slice at a time, so nothing is decoded until it's read.
+
+Basic usage::
+
+    from trace_store import create_traces, TraceReader
+    zwaves = create_traces(root, 'traces/waves', (N, scope.adc.samples), bits=adc_bits(scope))
+    writer = ChunkWriter(zwaves, convert=encoder(zwaves))
+    ...
+    waves = TraceReader(root['traces/waves'])
+    waves[0:100] # float64, same values as trace.wave
+"""
+import numpy as np
+
+
+def adc_bits(scope):
+    """Number of bits per ADC sample for a ChipWhisperer scope (10 unless it says otherwise)."""
+    return getattr(scope.adc, 'bits_per_sample', 10)
+
+
+def make_compressor(compressor='zstd', clevel=5):
+    """Return a numcodecs compressor.
+
+    Args:
+        compressor (str, numcodecs codec or None): A Blosc cname ('zstd',
+            'lz4', 'blosclz', 'zlib', ...), 'Zstd' for plain Zstandard, a
+            codec instance (returned as is) or None for no compression.
+        clevel (int): Compression level.
+    """
+    if compressor is None or not isinstance(compressor, str):
+        return compressor
+    from numcodecs import Blosc, Zstd
+    if compressor == 'Zstd':
+        return Zstd(level=clevel)
+    # bit shuffling works best on ADC codes, where the upper bits barely change
+    return Blosc(cname=compressor, clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+
+
+def create_traces(group, name, shape, bits=10, raw=True, dtype='uint16', chunks=(2500, None),
+                  compressor='zstd', clevel=5, overwrite=False):
+    """Create a zarr array for traces.
+
+    Args:
+        group (zarr.Group): Group to create the array in.
+        name (str): Name/path of the array in the group.
+        shape (tuple): (traces, samples).
+        bits (int): ADC bits per sample, see :func:`adc_bits`.
+        raw (bool): Store integer ADC codes (dtype) with a scale/offset if True,
+            otherwise float64 as before.
+        dtype (str): Integer dtype for raw codes, 'uint16' or 'int16'.
+        chunks (tuple): Chunk shape, None in a dimension means the full length.
+        compressor: See :func:`make_compressor`.
+        clevel (int): Compression level.
+
+    Returns:
+        zarr.Array: The new (empty) array.
+    """
+    if not raw:
+        dtype = 'float64'
+    arr = group.zeros(name, shape=shape, chunks=chunks, dtype=dtype, overwrite=overwrite,
+                      compressor=make_compressor(compressor, clevel))
+    if raw:
+        scale = 2.0 ** -bits
+        # int16 codes are centered on 0, uint16 codes start at 0
+        offset = 0.0 if np.dtype(dtype).kind == 'i' else -0.5
+        arr.attrs.update({'scale': scale, 'offset': offset, 'bits': bits})
+    return arr
+
+
+def encoder(array):
+    """Return a function converting float traces into the stored representation of array.
+
+    For float arrays this is a no-op. Pass it as ``ChunkWriter(array, convert=encoder(array))``.
+    """
+    scale = array.attrs.get('scale')
+    if scale is None:
+        return None
+    offset = array.attrs['offset']
+    info = np.iinfo(array.dtype)
+
+    def encode(waves):
+        codes = np.rint((np.asarray(waves) - offset) / scale)
+        return np.clip(codes, info.min, info.max).astype(array.dtype)
+    return encode
+
+
+class TraceReader:
+    """Lazy float view of a trace array created by :func:`create_traces`.
+
+    Indexing reads and decodes only the requested part of the array. Arrays
+    stored as floats are passed through unchanged.
+
+    Args:
+        array (zarr.Array): The trace array.
+        dtype (str): Float dtype to decode to.
+    """
+    def __init__(self, array, dtype='float64'):
+        self.array = array
+        self.dtype = np.dtype(dtype)
+        self.scale = array.attrs.get('scale')
+        self.offset = array.attrs.get('offset', 0.0)
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def chunks(self):
+        return self.array.chunks
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, index):
+        data = self.array[index]
+        if self.scale is None:
+            return np.asarray(data, dtype=self.dtype)
+        return data.astype(self.dtype) * self.dtype.type(self.scale) + self.dtype.type(self.offset)
+
+    def __iter__(self):
+        step = self.array.chunks[0]
+        for start in range(0, len(self), step):
+            for trace in self[start:start + step]:
+                yield trace
@@ -4,8 +4,13 @@ import zarr
 import numpy as np
 from cwtvla.ktp import FixedVRandomText, FixedVRandomKey, SemiFixedVRandomText, verify_AES
 import cwtvla.analysis as analysis
+from online_ttest import TVLATTest, t_test_zarr
+from capture_pipeline import CapturePipeline, ChunkWriter, capture_trace
+from trace_store import create_traces, encoder, adc_bits
+from campaign import Campaign
+from batch_ktp import BatchFixedVRandomText, verify_AES_batch
 import matplotlib.pyplot as plt
-from tqdm import trange
+from tqdm import tqdm
 
 def setup_device(name):
     scope = cw.scope()
@@ -52,80 +57,119 @@ def setup_device(name):
 
     return scope,target
 
-def random_v_random_capture(platform, key_len=16, N=10000):
+def random_v_random_capture(platform, key_len=16, N=10000, raw=True, compressor='zstd', resume=True, seed=None):
     #may not be working
     scope,target = setup_device(platform)
-    ktp = FixedVRandomText(key_len)
-    store = zarr.DirectoryStore('data/{}-{}-{}.zarr'.format(platform,N,key_len))
-    root = zarr.group(store=store, overwrite=True)
-
-    zwaves = root.zeros('traces/waves', shape=(2*N, scope.adc.samples), chunks=(2500, None), dtype='float64')
-    ztextins = root.zeros('traces/textins', shape=(2*N, 16), chunks=(2500, None), dtype='uint8')
+    # seeded, so the texts can be regenerated from the store's campaign attrs
+    ktp = BatchFixedVRandomText(key_len, seed=seed)
+    # picks up where an interrupted run with the same store left off
+    campaign = Campaign('data/{}-{}-{}.zarr'.format(platform,N,key_len), ktp, 2*N, resume=resume)
+    if campaign.cursor == 0:
+        # raw ADC codes + scale/offset, read back as floats with trace_store.TraceReader
+        create_traces(campaign.root, 'traces/waves', (2*N, scope.adc.samples), bits=adc_bits(scope),
+                      raw=raw, compressor=compressor, overwrite=True)
+        campaign.root.zeros('traces/textins', shape=(2*N, 16), chunks=(2500, None), dtype='uint8', overwrite=True)
+    else:
+        print("Resuming from trace {}".format(campaign.cursor))
+    chunk = campaign.root['traces/waves'].chunks[0]
+    pending = []
 
-    waves = zwaves[:,:]
-    textins = ztextins[:,:]
-    
-    for i in trange(2*N):
+    def capture(i):
         key, text = ktp.next_group_B()
-        trace = cw.capture_trace(scope, target, text, key)
-        while trace is None:
-            trace = cw.capture_trace(scope, target, text, key)
-
-        if not verify_AES(text, key, trace.textout):
-            raise ValueError("Encryption failed")
+        trace = capture_trace(scope, target, text, key)
+        return {'traces/waves': trace.wave, 'traces/textins': np.array(text),
+                'key': key, 'textout': trace.textout}
+
+    def process(i, row):
+        pending.append((row['traces/textins'], row['key'], row['textout']))
+        # check a chunk at a time, before the campaign commits it
+        if (i + 1) % chunk == 0 or i + 1 == 2*N:
+            texts, keys, textouts = zip(*pending)
+            del pending[:]
+            if not verify_AES_batch(texts, keys, textouts).all():
+                raise ValueError("Encryption failed")
         #project.traces.append(trace)
-        waves[i, :] = trace.wave
-        textins[i, :] = np.array(text)
-    zwaves[:,:] = waves[:,:]
-    ztextins[:,:] = textins[:,:]
+
+    with tqdm(total=2*N, initial=campaign.cursor) as bar:
+        stats = campaign.run(capture, ['traces/waves', 'traces/textins'], process, bar.update)
+    print("Captured {:.1f} traces/s".format(stats['traces_per_second']))
     print("Last encryption took {} samples".format(scope.adc.trig_count))
 
 
 
-def do_invariant_test(ktp_class, platform, N=10000, key_len=16):
+def do_invariant_test(ktp_class, platform, N=10000, key_len=16, order=1, stop_early=False, check_every=1000,
+                      store=None, raw=True, compressor='zstd'):
     # may not be working
     scope, target = setup_device(platform)
     #scope.adc.offset = 20000
     ktp = ktp_class(key_len)
     #ktp = FixedVRandomKey(key_len)
-    #store = zarr.DirectoryStore('SFvR/{}-{}-{}-{}.zarr'.format(platform, ktp._name, N, key_len))
-    #root = zarr.group(store=store, overwrite=True)
-    root = zarr.group("")
-    zgroup1 = root.zeros('traces/group1', shape=(N, scope.adc.samples), chunks=(2500, None), dtype='float64')
-    zgroup2 = root.zeros('traces/group2', shape=(N, scope.adc.samples), chunks=(2500, None), dtype='float64')
-
-    group1 = zgroup1[:,:]
-    group2 = zgroup2[:,:]
-    for i in trange(N):
-        key, text = ktp.next_group_A()
-        trace = cw.capture_trace(scope, target, text, key)
-        while trace is None:
-            trace = cw.capture_trace(scope, target, text, key)
-
-        if not verify_AES(text, key, trace.textout):
-            raise ValueError("Encryption failed")
-        group1[i,:] = trace.wave[:]
-
-        key, text = ktp.next_group_B() 
-        trace = cw.capture_trace(scope, target, text, key)
-        while trace is None:
-            trace = cw.capture_trace(scope, target, text, key)
 
-        group2[i,:] = trace.wave[:]
-        if not verify_AES(text, key, trace.textout):
+    # the t-test only needs the running moments, traces are only kept if a store is given
+    acc = TVLATTest(scope.adc.samples, order=order)
+    writers = None
+    if store:
+        #store = 'SFvR/{}-{}-{}-{}.zarr'.format(platform, ktp._name, N, key_len)
+        root = zarr.group(store=zarr.DirectoryStore(store), overwrite=True)
+        writers = []
+        for name in ('traces/group1', 'traces/group2'):
+            zgroup = create_traces(root, name, (N, scope.adc.samples), bits=adc_bits(scope),
+                                   raw=raw, compressor=compressor)
+            writers.append(ChunkWriter(zgroup, convert=encoder(zgroup)))
+
+    def capture(i):
+        key_a, text_a = ktp.next_group_A()
+        trace_a = capture_trace(scope, target, text_a, key_a)
+        key_b, text_b = ktp.next_group_B()
+        trace_b = capture_trace(scope, target, text_b, key_b)
+        return (key_a, text_a, trace_a), (key_b, text_b, trace_b)
+
+    # captured, but not verified yet: nothing reaches acc or the store before it is
+    pending = []
+
+    def commit():
+        if not pending:
+            return
+        texts, keys, textouts = zip(*[(text, key, trace.textout) for group, key, text, trace in pending])
+        if not verify_AES_batch(texts, keys, textouts).all():
+            del pending[:]
             raise ValueError("Encryption failed")
+        for group, key, text, trace in pending:
+            acc.add(group, trace.wave)
+            if writers:
+                writers[group].append(trace.wave)
+        del pending[:]
+
+    def process(i, item):
+        for group, (key, text, trace) in enumerate(item):
+            pending.append((group, key, text, trace))
+
+        # encryptions are checked in batches, but always before the t-test is looked at
+        if (i + 1) % check_every == 0 or i + 1 == N:
+            commit()
+
+        if stop_early and (i + 1) % check_every == 0 and acc.failed(order=order):
+            print("Leakage confirmed after {} traces per group, stopping early".format(i + 1))
+            pipeline.stop()
+
+    pipeline = CapturePipeline(capture, process)
+    with tqdm(total=N) as bar:
+        pipeline.run(N, bar.update)
+    # traces still queued when the pipeline was stopped
+    commit()
+    if writers:
+        for writer in writers:
+            writer.flush()
+
+    return acc
 
     
 if __name__ == "__main__":
-    from guppy import hpy
-    hp = hpy()
-    hp.setrelheap()
-    z = zarr.open("SFvR/STM32F4-SemiFixedVRandomText-5000-16.zarr")
+    path = "SFvR/STM32F4-SemiFixedVRandomText-5000-16.zarr"
+    z = zarr.open(path, mode='r')
     print(z.tree())
-    group1 = z.traces.group1[:,:]
-    group2 = z.traces.group2[:,:]
-    print(hp.heap())
-    t = analysis.t_test(group1, group2)
+    # walks the store chunk by chunk on all cores and stores the result in analysis/t_order1
+    t = t_test_zarr(path).t_value()
     import matplotlib.pyplot as plt
     plt.figure()
     plt.plot(t[0])
@@ -68,10 +68,10 @@ def update_from_remote(directory):
     if 'Already up to date.' not in out:
         updated = True
 
-    updated = True
-
-    # Always update the jupyter submodule
+    # Always update the jupyter submodule, it prints the new commit if it moved
     out, err = execute_command('git submodule update --init jupyter', directory)
+    if out:
+        updated = True
 
     if updated:
         logging.info('pulled new changes to repository')
@@ -7,6 +7,8 @@ import os
 from os.path import isfile, join
 import yaml
 import re
+import hashlib
+import json
 import sys
 from pprint import pprint
 
@@ -68,6 +70,387 @@ class cd:
     def __exit__(self, exc_type, exc_val, exc_tb):
         os.chdir(self.saved_path)
 
+#: Default ResultCache directory of run_tests.
+CACHE_DIR = os.environ.get('CW_TEST_CACHE', os.path.join(tests_dir, '.result_cache'))
+
+#: Modules imported into every pooled kernel before it is handed out.
+WARM_IMPORTS = [
+    'numpy',
+    'matplotlib.pyplot',
+    'bokeh.plotting',
+    'holoviews',
+    'tqdm',
+    'chipwhisperer',
+    'chipwhisperer.analyzer',
+]
+
+_WARM_CODE = """
+import importlib as _importlib, os as _os, site as _site, sys as _sys, sysconfig as _sysconfig
+for _name in {modules!r}:
+    try:
+        _importlib.import_module(_name)
+    except Exception:
+        pass
+_sys._kernel_pool_path = list(_sys.path)
+_sys._kernel_pool_modules = set(_sys.modules)
+_sys._kernel_pool_installed = tuple(_os.path.join(_os.path.realpath(_path), '') for _path in
+    [_sysconfig.get_path(_key) for _key in ('stdlib', 'platstdlib', 'purelib', 'platlib')] + [_site.getusersitepackages()])
+"""
+
+_RESET_CODE = """
+import importlib as _importlib, os as _os, sys as _sys
+for _name in ('scope', 'target'):
+    try:
+        get_ipython().user_ns[_name].dis()
+    except Exception:
+        pass
+if 'matplotlib.pyplot' in _sys.modules:
+    _sys.modules['matplotlib.pyplot'].close('all')
+_sys.path[:] = _sys._kernel_pool_path
+for _name, _module in list(_sys.modules.items()):
+    _file = getattr(_module, '__file__', None)
+    if not _file:
+        continue
+    _file = _os.path.realpath(_file)
+    if not _file.startswith(_sys._kernel_pool_installed) and (
+            _file.startswith({root!r}) or _name not in _sys._kernel_pool_modules):
+        del _sys.modules[_name]
+_importlib.invalidate_caches()
+_os.chdir({path!r})
+get_ipython().reset(new_session=True)
+"""
+
+
+class KernelPool:
+    """Pool of started Jupyter kernels with the heavy imports already done.
+
+    Starting a kernel and importing chipwhisperer, bokeh, holoviews etc.
+    takes seconds, so instead of a new kernel per notebook, execute_notebook
+    can borrow one of these. Before a kernel is handed out its namespace is
+    reset (the scope and target are disconnected, figures closed, user
+    variables, execution count and sys.path reset) and its working directory
+    is changed to the notebook's. Modules loaded from under root, and any
+    other module imported since the kernel started that isn't an installed
+    library, are dropped from sys.modules, so a notebook's own helpers
+    (a setup.py or util.py next to it) are imported afresh. Installed
+    libraries stay loaded, so module level state in them is shared between
+    the notebooks run on one kernel; set max_uses to restart kernels every
+    so often. Dead kernels are restarted when they are returned.
+
+    Args:
+        size (int): Number of kernels.
+        kernel_name (str): Kernel spec to start.
+        warm_imports (list): Modules to import into each kernel. Defaults to
+            WARM_IMPORTS. Modules that fail to import are skipped.
+        max_uses (int): Restart a kernel after this many notebooks. None
+            never restarts live kernels.
+        root (str): Tree the tutorials and their helper modules are in.
+            Defaults to the repository these tests are in.
+    """
+
+    def __init__(self, size=1, kernel_name='python3', warm_imports=None, max_uses=None, root=None):
+        from queue import Queue
+        self.kernel_name = kernel_name
+        self.root = os.path.join(os.path.realpath(root or os.path.join(tests_dir, '..')), '')
+        self.warm_imports = WARM_IMPORTS if warm_imports is None else warm_imports
+        self.max_uses = max_uses
+        self._uses = {}
+        self._idle = Queue()
+        managers = [self._start() for i in range(size)]
+        for km in managers:
+            self._warm(km)
+            self._idle.put(km)
+
+    def _start(self):
+        from jupyter_client import KernelManager
+        km = KernelManager(kernel_name=self.kernel_name)
+        km.start_kernel()
+        self._uses[km] = 0
+        return km
+
+    def _run(self, km, code, timeout=120):
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=timeout)
+            msg_id = kc.execute(code, silent=True, store_history=False)
+            while True:
+                reply = kc.get_shell_msg(timeout=timeout)
+                if reply['parent_header'].get('msg_id') == msg_id:
+                    break
+            if reply['content']['status'] != 'ok':
+                raise RuntimeError('Kernel setup failed: {}: {}'.format(
+                    reply['content'].get('ename'), reply['content'].get('evalue')))
+        finally:
+            kc.stop_channels()
+
+    def _warm(self, km):
+        self._run(km, _WARM_CODE.format(modules=list(self.warm_imports)))
+
+    def acquire(self, path='.'):
+        """Takes an idle kernel, waiting for one if needed, and resets it.
+
+        Args:
+            path (str): Working directory for the notebook.
+
+        Returns:
+            KernelManager: Pass it to ExecutePreprocessor.preprocess(km=...),
+            then hand it back with release().
+        """
+        km = self._idle.get()
+        try:
+            self._run(km, _RESET_CODE.format(path=os.path.abspath(path), root=self.root))
+        except Exception:
+            # a kernel that can't be reset is as good as dead
+            self.release(self._replace(km))
+            return self.acquire(path)
+        self._uses[km] += 1
+        return km
+
+    def _replace(self, km):
+        self._uses.pop(km, None)
+        try:
+            km.shutdown_kernel(now=True)
+        except Exception:
+            pass
+        km = self._start()
+        self._warm(km)
+        return km
+
+    def release(self, km):
+        """Returns a kernel from acquire() to the pool."""
+        if not km.is_alive() or (self.max_uses and self._uses.get(km, 0) >= self.max_uses):
+            km = self._replace(km)
+        self._idle.put(km)
+
+    def shutdown(self):
+        """Shuts down all idle kernels."""
+        while not self._idle.empty():
+            km = self._idle.get()
+            km.shutdown_kernel(now=True)
+            self._uses.pop(km, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+def _git(args, directory):
+    import subprocess
+    result = subprocess.run(['git'] + args, cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode:
+        return None
+    return result.stdout
+
+
+def _hash_tree(directory):
+    sha = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            sha.update(os.path.relpath(path, directory).encode())
+            with open(path, 'rb') as f:
+                sha.update(hashlib.sha256(f.read()).digest())
+    return sha.hexdigest()
+
+
+def chipwhisperer_version():
+    """Identifies the chipwhisperer code the notebooks run against.
+
+    Combines the commit of the chipwhisperer repository this jupyter checkout
+    is a submodule of (firmware is built from there) with the installed
+    chipwhisperer package: its commit if it is a git checkout (an editable
+    install), else a hash of its files. Uncommitted changes are hashed in.
+
+    Returns:
+        str
+    """
+    import importlib.util
+    parts = []
+    superproject = _git(['rev-parse', '--show-superproject-working-tree'], tests_dir)
+    directories = [superproject.decode().strip()] if superproject and superproject.strip() else []
+    spec = importlib.util.find_spec('chipwhisperer')
+    package_dir = os.path.dirname(spec.origin) if spec and spec.origin else None
+    if package_dir:
+        directories.append(package_dir)
+    for directory in directories:
+        head = _git(['rev-parse', 'HEAD'], directory)
+        if head:
+            diff = _git(['diff', 'HEAD'], directory) or b''
+            parts.append(head.decode().strip() + ('+' + hashlib.sha256(diff).hexdigest()[:12] if diff else ''))
+        else:
+            parts.append(_hash_tree(directory))
+    return ' '.join(parts) or 'not installed'
+
+
+def notebook_dependencies(nb_path):
+    """Notebooks pulled in by %run from nb_path, recursively.
+
+    Like InLineCodePreprocessor, relative paths are resolved from the
+    directory of nb_path, which is where the kernel runs.
+
+    Returns:
+        list: Paths of the notebooks, in the order first found.
+    """
+    notebook_dir = os.path.dirname(nb_path)
+    p = re.compile(r"%run\s*[\"']?(.*\.ipynb)[\"']?")
+    found = []
+    todo = [nb_path]
+    while todo:
+        path = todo.pop(0)
+        try:
+            nb = nbformat.read(path, as_version=4)
+        except (OSError, ValueError):
+            continue
+        for cell in nb.cells:
+            if cell['cell_type'] != 'code':
+                continue
+            for ext_nb in p.findall(cell['source']):
+                ext_path = os.path.join(notebook_dir, ext_nb)
+                if ext_path not in found:
+                    found.append(ext_path)
+                    todo.append(ext_path)
+    return found
+
+
+def cache_params(serial_number=None, allow_errors=True, allowable_exceptions=None, baud=None, **kwargs):
+    """The test_notebook arguments that change a test's result, as one dict."""
+    params = dict(kwargs)
+    params.update(serial_number=serial_number, allow_errors=allow_errors,
+                  allowable_exceptions=allowable_exceptions, baud=baud)
+    return params
+
+
+class ResultCache:
+    """Results of passing notebook tests, keyed by everything they depend on.
+
+    The key is a hash of the notebook, the notebooks it %runs, the test
+    parameters (cache_params), chipwhisperer_version() and this script and
+    its ReST template. A hit restores the exported ReST/HTML and images into
+    the output directory, so test_notebook can skip executing it. Only
+    passing runs are stored, failures are always run again. Data files the
+    notebooks read (traces, firmware outside the chipwhisperer repository)
+    aren't part of the key; delete cache_dir to force a full run.
+
+    Each entry is a directory with the executed notebook (notebook.ipynb),
+    the test output (output.txt) and the exported files (files/).
+
+    Args:
+        cache_dir (str): Where entries are kept. Created if needed.
+        version (str): chipwhisperer_version(), computed if not given.
+    """
+
+    def __init__(self, cache_dir, version=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.version = chipwhisperer_version() if version is None else version
+        sha = hashlib.sha256()
+        for name in ('tutorials.py', 'rst_extended.tpl'):
+            with open(os.path.join(tests_dir, name), 'rb') as f:
+                sha.update(f.read())
+        self._tools = sha.hexdigest()
+
+    def key(self, nb_path, params):
+        """Returns the cache key (hex str) of a notebook run with params."""
+        sources = []
+        for path in [nb_path] + notebook_dependencies(nb_path):
+            try:
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+            except OSError:
+                digest = None
+            sources.append((os.path.relpath(path, os.path.dirname(nb_path)), digest))
+        material = {
+            'sources': sources,
+            'params': params,
+            'chipwhisperer': self.version,
+            'tools': self._tools,
+        }
+        return hashlib.sha256(json.dumps(material, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _load(self, key):
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, 'output.txt'), encoding='utf-8') as f:
+                cached_output = f.read()
+            with open(os.path.join(entry, 'files.json'), encoding='utf-8') as f:
+                files = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cached_output, files
+
+    def has(self, key, exported=True):
+        """Whether key is cached, with its exported files if exported."""
+        cached = self._load(key)
+        return cached is not None and (cached[1] is not None or not exported)
+
+    def restore(self, key, output_dir=None):
+        """Looks up key and copies its exported files into output_dir.
+
+        Args:
+            key (str): From key().
+            output_dir (str): Export directory, None if nothing is exported.
+
+        Returns:
+            str: The output of the cached run, None if there is no usable entry.
+        """
+        if not self.has(key, output_dir is not None):
+            return None
+        cached_output, files = self._load(key)
+        if output_dir is not None:
+            entry = self._entry(key)
+            for name in files:
+                target = os.path.join(output_dir, name)
+                os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+                shutil.copyfile(os.path.join(entry, 'files', name), target)
+        return cached_output
+
+    def notebook(self, key):
+        """Returns the executed notebook of a cached run, None if not cached."""
+        path = os.path.join(self._entry(key), 'notebook.ipynb')
+        if not os.path.isfile(path):
+            return None
+        return nbformat.read(path, as_version=4)
+
+    def store(self, key, nb, test_output, output_dir=None, files=()):
+        """Adds a passing run.
+
+        Args:
+            key (str): From key().
+            nb (str): The executed notebook, as nbformat.writes() text.
+            test_output (str): Output of test_notebook.
+            output_dir (str): Export directory, None if it wasn't exported.
+            files (list): Exported files, relative to output_dir.
+        """
+        import tempfile
+        entry = self._entry(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # build the entry next to its final place, then rename it there, so
+        # processes running the same test never see half an entry
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        try:
+            with open(os.path.join(tmp, 'notebook.ipynb'), 'w', encoding='utf-8') as f:
+                f.write(nb)
+            with open(os.path.join(tmp, 'output.txt'), 'w', encoding='utf-8') as f:
+                f.write(test_output)
+            for name in files:
+                target = os.path.join(tmp, 'files', name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(os.path.join(output_dir, name), target)
+            with open(os.path.join(tmp, 'files.json'), 'w', encoding='utf-8') as f:
+                json.dump(None if output_dir is None else list(files), f)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
 def put_all_kwargs_in_notebook(params, **kwargs):
     for kwarg in kwargs:
         in_params = False
@@ -78,8 +461,11 @@ def put_all_kwargs_in_notebook(params, **kwargs):
             print(f"Inserting {kwarg}")
             params.append(Parameter(kwarg, str, kwargs[kwarg]))
 
-def execute_notebook(nb_path, serial_number=None, baud=None, allow_errors=True, SCOPETYPE='OPENADC', PLATFORM='CWLITEARM', **kwargs):
+def execute_notebook(nb_path, serial_number=None, baud=None, allow_errors=True, SCOPETYPE='OPENADC', PLATFORM='CWLITEARM', kernel_pool=None, **kwargs):
     """Execute a notebook via nbconvert and collect output.
+
+       If kernel_pool (a KernelPool) is given, the notebook runs on one of
+       its kernels instead of a newly started one.
        :returns (parsed nb object, execution errors)
     """
     notebook_dir, file_name = os.path.split(nb_path)
@@ -127,7 +513,15 @@ def execute_notebook(nb_path, serial_number=None, baud=None, allow_errors=True,
             rp = RegexReplacePreprocessor(replacements)
             nb, resources = rp.preprocess(nb, {})
 
-        if notebook_dir:
+        if kernel_pool:
+            km = kernel_pool.acquire(notebook_dir or '.')
+            try:
+                nb, resources = ep.preprocess(nb, {'metadata': {'path': './'}}, km=km)
+            finally:
+                if ep.kc:
+                    ep.kc.stop_channels()
+                kernel_pool.release(km)
+        elif notebook_dir:
             with cd(notebook_dir):
                 nb, resources = ep.preprocess(nb, {'metadata': {'path': './'}})
         else:
@@ -155,6 +549,9 @@ def export_notebook(nb, nb_path, output_dir, SCOPETYPE=None, PLATFORM=None):
         output_dir (str): The output directory for the ReST and HTML file.
         SCOPETYPE (str): Used to generate the output file name.
         PLATFORM (str): Used to generate the output file name.
+
+    Returns:
+        list: The written files, relative to output_dir.
     """
 
     notebook_dir, file_name = os.path.split(nb_path)
@@ -173,31 +570,131 @@ def export_notebook(nb, nb_path, output_dir, SCOPETYPE=None, PLATFORM=None):
     ebp = EscapeBacktickPreprocessor()
 
     rst_ready_nb, _ = ebp.preprocess(nb, {})
-    with open(rst_path, 'w', encoding='utf-8') as rst_file:
-        rst_exporter = RSTExporter()
+    rst_exporter = RSTExporter()
+    body, res = rst_exporter.from_notebook_node(rst_ready_nb, resources={'unique_key': 'img/{}-{}-{}'.format(SCOPETYPE, PLATFORM, file_name_root).replace(' ', '')})
+
+    # name images by their contents, so a plot that comes out the same in
+    # several notebooks or configurations is only stored (and written) once
+    file_names = []
+    for name in sorted(res['outputs'], key=len, reverse=True):
+        data = res['outputs'][name]
+        _, ext = os.path.splitext(name)
+        hashed_name = 'img/{}{}'.format(hashlib.sha256(data).hexdigest()[:20], ext)
+        body = body.replace(name, hashed_name)
+        if hashed_name not in file_names:
+            file_names.append(hashed_name)
+            if _write_if_changed(os.path.join(output_dir, hashed_name), data):
+                print('writing to ', hashed_name)
+
+    if _write_if_changed(rst_path, body.encode('utf-8')):
+        print('Wrote to: ', rst_path)
+    else:
+        print('Unchanged: ', rst_path)
 
+    html_exporter = HTMLExporter()
+    body, res = html_exporter.from_notebook_node(nb)
+    if _write_if_changed(html_path, body.encode('utf-8')):
+        print('Wrote to: ', html_path)
+    else:
+        print('Unchanged: ', html_path)
 
-        body, res = rst_exporter.from_notebook_node(rst_ready_nb, resources={'unique_key': 'img/{}-{}-{}'.format(SCOPETYPE, PLATFORM, file_name_root).replace(' ', '')})
-        file_names = res['outputs'].keys()
-        for name in file_names:
-            with open(os.path.join(output_dir, name), 'wb') as f:
-                f.write(res['outputs'][name])
-                print('writing to ', name)
-            #print(res['outputs'][name])
+    return file_names + [os.path.relpath(path, output_dir) for path in (rst_path, html_path)]
 
 
-        rst_file.write(body)
-        print('Wrote to: ', rst_path)
+def _write_if_changed(path, data):
+    """Writes data (bytes) to path, unless the file already holds exactly that.
 
-        ## need resources
+    Returns:
+        bool: Whether the file was written.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+    # other export processes may be reading or writing the same image
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return True
 
-    with open(html_path, 'w', encoding='utf-8') as html_file:
-        html_exporter = HTMLExporter()
 
-        body, res = html_exporter.from_notebook_node(nb)
+def _export_worker(queue):
+    """Exports notebooks from queue until it gets None.
 
-        html_file.write(body)
-        print('Wrote to: ', html_path)
+    Returns:
+        tuple: (number exported, [(export_tag, message), ...] of the failed ones)
+    """
+    exported = 0
+    failures = []
+    while True:
+        job = queue.get()
+        if job is None:
+            return exported, failures
+        nb, nb_path, output_dir, export_kwargs, cache, key, test_output, export_tag = job
+        output[:] = list()
+        try:
+            files = export_notebook(nbformat.reads(nb, as_version=4), nb_path, output_dir, **export_kwargs)
+            if cache:
+                cache.store(key, nb, test_output, output_dir, files)
+            exported += 1
+        except Exception as e:
+            message = 'Exporting {} {} failed: {}: {}'.format(nb_path, export_kwargs, type(e).__name__, e)
+            print(message)
+            failures.append((export_tag, message))
+
+
+class ExportStage:
+    """Exports executed notebooks to ReST and HTML in a separate process pool.
+
+    test_notebook(export_queue=stage.queue) puts the executed notebook on
+    the queue and goes on to the next test instead of exporting it itself.
+    The queue is a multiprocessing.Manager queue, so it can be handed to
+    Pool workers. Passing runs are added to their ResultCache by the
+    export process, once their files exist. Failed exports are returned by
+    close(), with the export_tag given to test_notebook, so the test can
+    be reported as failed.
+
+    Args:
+        processes (int): Number of export processes.
+    """
+
+    def __init__(self, processes=1):
+        import multiprocessing
+        from multiprocessing.pool import Pool
+        self._manager = multiprocessing.Manager()
+        self.queue = self._manager.Queue()
+        self.processes = processes
+        self._pool = Pool(processes)
+        self._workers = [self._pool.apply_async(_export_worker, (self.queue,)) for i in range(processes)]
+
+    def close(self):
+        """Waits for all queued exports to finish.
+
+        Returns:
+            tuple: (number exported, failures). failures is a list of
+            (export_tag, message), export_tag being what was given to
+            test_notebook.
+        """
+        for i in range(self.processes):
+            self.queue.put(None)
+        exported = 0
+        failures = []
+        for worker in self._workers:
+            count, worker_failures = worker.get()
+            exported += count
+            failures.extend(worker_failures)
+        self._pool.close()
+        self._pool.join()
+        self._manager.shutdown()
+        return exported, failures
+
+    def terminate(self):
+        """Stops without finishing the queued exports."""
+        self._pool.terminate()
+        self._manager.shutdown()
 
 
 def _print_tracebacks(errors):
@@ -232,7 +729,7 @@ def _print_stdout(nb):
 
 
 def test_notebook(nb_path, output_dir, serial_number=None, export=True, allow_errors=True, print_first_traceback_only=True, print_stdout=False, print_stderr=False,
-                  allowable_exceptions=None, baud=None, **kwargs):
+                  allowable_exceptions=None, baud=None, kernel_pool=None, cache=None, export_queue=None, export_tag=None, **kwargs):
     # reset output for next test
     output[:] = list()
     passed = False
@@ -243,12 +740,22 @@ def test_notebook(nb_path, output_dir, serial_number=None, export=True, allow_er
         print('on device with serial number {}.'.format(serial_number))
     else:
         print('No serial number specified... only bad if more than one device attached.')
-    nb, errors, export_kwargs = execute_notebook(nb_path, serial_number, allow_errors=allow_errors, allowable_exceptions=allowable_exceptions, baud=baud, **kwargs)
+    key = None
+    if cache:
+        key = cache.key(nb_path, cache_params(serial_number, allow_errors, allowable_exceptions, baud, **kwargs))
+        cached_output = cache.restore(key, output_dir if export else None)
+        if cached_output is not None:
+            print("Unchanged since a passing run, reusing its results ({})".format(key[:12]))
+            return True, '\n'.join(output + [cached_output])
+    exported = []
+    nb, errors, export_kwargs = execute_notebook(nb_path, serial_number, allow_errors=allow_errors, allowable_exceptions=allowable_exceptions, baud=baud, kernel_pool=kernel_pool, **kwargs)
+    # exporting escapes the outputs in place, keep the notebook as executed
+    executed_nb = nbformat.writes(nb) if cache or export_queue is not None else None
     if not errors:
         print("PASSED")
         passed = True
-        if export:
-            export_notebook(nb, nb_path, output_dir, **export_kwargs)
+        if export and export_queue is None:
+            exported = export_notebook(nb, nb_path, output_dir, **export_kwargs)
     else:
         if allowable_exceptions:
             error_is_acceptable = [error[1]['ename'] in allowable_exceptions for error in errors]
@@ -257,8 +764,8 @@ def test_notebook(nb_path, output_dir, serial_number=None, export=True, allow_er
                 passed = True
                 for error in errors:
                     print(error[1]['ename'], ':', error[1]['evalue'])
-                if export:
-                    export_notebook(nb, nb_path, output_dir, **export_kwargs)
+                if export and export_queue is None:
+                    exported = export_notebook(nb, nb_path, output_dir, **export_kwargs)
             else:
                 print("FAILED {} config {}:".format(nb_path, kwargs))
                 passed = False
@@ -277,6 +784,12 @@ def test_notebook(nb_path, output_dir, serial_number=None, export=True, allow_er
         _print_stdout(nb)
     if print_stderr:
         _print_stderr(nb)
+    if passed and export and export_queue is not None:
+        # the export stage adds it to the cache once the files are written
+        print("Queued for export")
+        export_queue.put((executed_nb, nb_path, output_dir, export_kwargs, cache, key, '\n'.join(output), export_tag))
+    elif cache and passed:
+        cache.store(key, executed_nb, '\n'.join(output), output_dir if export else None, exported)
 
     return passed, '\n'.join(output)
 
@@ -399,6 +912,28 @@ class RegexReplacePreprocessor(nbconvert.preprocessors.Preprocessor):
         return cell, resources
 
 
+_exported_python = {}
+
+def notebook_python(path):
+    """Returns the notebook at path exported with PythonExporter.
+
+    The code is kept for the rest of the process, keyed by path and
+    modification time, so a helper notebook %run by every tutorial is only
+    exported again if it changes.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _exported_python.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+    ext_nb_node = nbformat.read(path, as_version=4)
+    python_exporter = nbconvert.exporters.PythonExporter()
+    python_code, _ = python_exporter.from_notebook_node(ext_nb_node)
+    _exported_python[path] = (version, python_code)
+    return python_code
+
+
 class InLineCodePreprocessor(nbconvert.preprocessors.Preprocessor):
     """Preprocessor that in lines code instead of using %run in nb.
 
@@ -413,7 +948,8 @@ class InLineCodePreprocessor(nbconvert.preprocessors.Preprocessor):
     processed.
 
 
-    TODO: This needs to handle nested run blocks and indented run blocks - DONE
+    Nested and indented runs are handled. Each notebook is only exported
+    once per process (see notebook_python), however often it is run.
 
     Args:
         notebook_dir (str): The path to the directory containing all the
@@ -429,50 +965,40 @@ class InLineCodePreprocessor(nbconvert.preprocessors.Preprocessor):
         self.notebook_dir = notebook_dir
         super().__init__(**kwargs)
 
+    # a %run of a notebook, as typed in a cell or as PythonExporter writes it,
+    # on a line of its own: (indentation, magic, path, path, rest of the line)
+    _run_line = re.compile(r"""^([ \t]*)(%run\s*["']?(.*\.ipynb)["']?|get_ipython\(\)\.run_line_magic\('run', '["']?(.*?\.ipynb)["']?'\))(.*)$""")
+
+    def inline(self, source, _stack=()):
+        """Returns source with every %run of a notebook replaced by its code.
+
+        Runs in the inlined code are expanded too, at the indentation of the
+        line they replace.
+        """
+        lines = []
+        for line in source.split('\n'):
+            match = self._run_line.match(line)
+            if not match:
+                lines.append(line)
+                continue
+            indent, ext_nb, rest = match.group(1), match.group(3) or match.group(4), match.group(5)
+            ext_nb_path = os.path.abspath(os.path.join(self.notebook_dir, ext_nb))
+            if ext_nb_path in _stack:
+                raise ValueError('{} runs itself'.format(ext_nb_path))
+            python_code = self.inline(notebook_python(ext_nb_path), _stack + (ext_nb_path,))
+            lines.append(indent)
+            lines.extend(indent + code_line for code_line in python_code.split('\n'))
+            lines.append(rest)
+        return '\n'.join(lines)
+
     def preprocess_cell(self, cell, resources, index):
         if cell['cell_type'] == 'code':
-            while ('%run' in cell['source']) or ("run_line_magic('run'" in cell['source']):
+            if ('%run' in cell['source']) or ("run_line_magic('run'" in cell['source']):
                 # to deal with other notebooks being called from the source notebook
                 # find the notebooks and export to python code and replace
                 # the current cell source code with that python code before
                 # replacing instances of cw.scope()
-                def regex_replace(p):
-                    # external_notebooks = re.findall(p, cell['source'])
-
-
-                    run_line = re.search(p, cell['source'])
-                    if not run_line:
-                        return
-                    run_position = run_line.start()
-                    num_tabs = 0
-                    num_spaces = 0
-                    x = cell['source']
-                    while True:
-                        if cell['source'][run_position-1] == '\t':
-                            num_tabs += 1
-                        elif cell['source'][run_position-1] == " ":
-                            num_spaces += 1
-                        else:
-                            break
-
-                        run_position -= 1
-
-                    # for full_match, ext_nb in external_notebooks:
-                    full_match = run_line.group()
-                    ext_nb = run_line.group(2)
-                    # print(run_line.group(1))
-                    # print(run_line.group(2))
-                    ext_nb_path = os.path.join(self.notebook_dir, ext_nb)
-                    ext_nb_node = nbformat.read(ext_nb_path, as_version=4)
-                    python_exporter = nbconvert.exporters.PythonExporter()
-                    python_code, _ = python_exporter.from_notebook_node(ext_nb_node)
-                    python_code = " " * num_spaces + "\t" * num_tabs + python_code.replace("\n", "\n{}{}".format(" " * num_spaces, "\t" * num_tabs))
-                    # print(str(num_spaces), str(num_tabs))
-                    cell['source'] = cell['source'].replace(full_match, '\n{}\n'.format(python_code))
-                p = re.compile(r"(%run\s*[\"']?(.*\.ipynb)[\"']?)")
-                regex_replace(p)
-                p = re.compile(r"(get_ipython\(\)\.run_line_magic\('run'\, \'\"(.*\.ipynb)\"\'\))")
-                regex_replace(p)
+                cell['source'] = self.inline(cell['source'])
 
             p2 = re.compile(r"(get_ipython\(\)\.run_cell_magic\('bash', '.*?', '(.*?)'\))", flags=re.DOTALL)
             run_line = re.finditer(p2, cell['source'])
@@ -499,8 +1025,15 @@ class InLineCodePreprocessor(nbconvert.preprocessors.Preprocessor):
                 # print(run_line.group(1))
                 # print(run_line.group(2))
                 space_tab = " " * num_spaces + "\t" * num_tabs
-                a = cell['source'].replace(full_match, f'try:\n{space_tab}    {full_match}\n{space_tab}except:\n{space_tab}    x=open("/tmp/tmp.txt").read(); print(x); raise OSError(x)\n')
-                a = a.replace(shell_cmd, shell_cmd + " &> /tmp/tmp.txt")
+                # the output goes to a temporary file of its own, notebooks
+                # run at the same time (see run_tests) can't mix theirs up
+                logged = full_match[:-len("')")] + " &> ' + _shlex.quote(_bash_out))"
+                a = cell['source'].replace(full_match,
+                    f'import os as _os, shlex as _shlex, tempfile as _tempfile\n'
+                    f'{space_tab}_bash_fd, _bash_out = _tempfile.mkstemp(suffix=".txt"); _os.close(_bash_fd)\n'
+                    f'{space_tab}try:\n{space_tab}    {logged}\n'
+                    f'{space_tab}except:\n{space_tab}    x=open(_bash_out).read(); print(x); raise OSError(x)\n'
+                    f'{space_tab}finally:\n{space_tab}    _os.remove(_bash_out)\n')
                 cell['source'] = a
                 # print(a)
                 # python_code = " " * num_spaces + "\t" * num_tabs + python_code.replace("\n", "\n{}{}".format(" " * num_spaces, "\t" * num_tabs))
@@ -509,54 +1042,172 @@ class InLineCodePreprocessor(nbconvert.preprocessors.Preprocessor):
 
         return cell, resources
 
+def config_tests(id, tutorials, connected_hardware, nb_dir='..'):
+    """Lists the tests to run with one connected hardware configuration.
+
+    Args:
+        id (int): Index of the configuration in connected_hardware.
+        tutorials (dict): From load_configuration.
+        connected_hardware (list): From load_configuration.
+        nb_dir (str): Directory the notebook paths are relative to.
+
+    Returns:
+        list: (id, nb, path, kwargs) for every notebook configuration that
+        lists id, in tutorials order. kwargs are the arguments for
+        test_notebook.
+    """
+    hw_settings = connected_hardware[id]
+    tests = []
+    for nb in tutorials.keys():
+        for test_config in tutorials[nb]['configurations']:
+            if id not in test_config['ids']:
+                continue # we don't need to test this hardware on this tutorial
+            kwargs = {
+                'SCOPETYPE': hw_settings['scope'],
+                'PLATFORM': hw_settings['target'],
+                'CRYPTO_TARGET': hw_settings['firmware'],
+                'serial_number': hw_settings.get('serial number'),
+                'VERSION': hw_settings['tutorial type'],
+                'SS_VER': test_config['ssver']
+
+            }
+
+            path = os.path.join(nb_dir, nb)
+            hw_kwargs = hw_settings.get('kwargs')
+            print("HW kwargs: {}".format(hw_kwargs))
+            if hw_kwargs:
+                kwargs.update(hw_kwargs)
+
+            tutorial_kwargs = test_config.get('kwargs')
+            if tutorial_kwargs:
+                kwargs.update(tutorial_kwargs)
+            tests.append((id, nb, path, kwargs))
+    return tests
+
+
+def needs_hardware(kwargs):
+    """Whether a test from config_tests uses a board.
+
+    SIMULATED tutorials (and configurations without a scope) never open a
+    scope, so they can run anywhere, at the same time as anything else.
+    """
+    return kwargs.get('VERSION') != 'SIMULATED' and kwargs.get('SCOPETYPE') not in (None, 'NONE')
+
+
+def schedule_tests(tutorials, connected_hardware, nb_dir='..'):
+    """Splits the tests of all connected configurations by what they need.
+
+    Returns:
+        tuple: (hw_queues (dict), free_tests (list)). hw_queues maps a serial
+        number to the tests that use that board, which have to run one at a
+        time. Configurations without a serial number share the None queue,
+        as they all open whichever board is attached. free_tests don't need
+        hardware. Tests are (index, id, nb, path, kwargs), index being the
+        position in the full, unscheduled list.
+    """
+    hw_queues = {}
+    free_tests = []
+    index = 0
+    for id in range(len(connected_hardware)):
+        for test in config_tests(id, tutorials, connected_hardware, nb_dir):
+            test = (index,) + test
+            index += 1
+            if needs_hardware(test[4]):
+                hw_queues.setdefault(test[4].get('serial_number'), []).append(test)
+            else:
+                free_tests.append(test)
+    return hw_queues, free_tests
+
+
+def run_test(test, output_dir, kernel_pool=None, cache=None, export_queue=None):
+    """Runs one test from schedule_tests.
+
+    Returns:
+        tuple: (index, id, passed, header, output)
+    """
+    index, id, nb, path, kwargs = test
+    print("Testing {} with {} ({})".format(nb, id, kwargs))
+    passed, output = test_notebook(nb_path=path, output_dir=output_dir, kernel_pool=kernel_pool, cache=cache, export_queue=export_queue, export_tag=index, **kwargs)
+    header = "{} {} with config {}\n".format("Passed" if passed else "Failed", nb, id)
+    return index, id, passed, header, output
+
+
+def _start_kernel_pool(warm_kernels):
+    if not warm_kernels:
+        return None
+    try:
+        return KernelPool(1)
+    except Exception as e:
+        print('Could not start a warm kernel ({}), starting one per notebook'.format(e))
+        return None
+
+
+def run_test_queue(queue, output_dir, warm_kernels=True, cache=None, export_queue=None):
+    """Runs a list of tests one after the other, on one warm kernel."""
+    kernel_pool = _start_kernel_pool(warm_kernels)
+    try:
+        return [run_test(test, output_dir, kernel_pool, cache, export_queue) for test in queue]
+    finally:
+        if kernel_pool:
+            kernel_pool.shutdown()
+
+
+_free_worker = {}
+
+def _init_free_worker(warm_kernels):
+    from multiprocessing import util
+    kernel_pool = _start_kernel_pool(warm_kernels)
+    if kernel_pool:
+        _free_worker['kernel_pool'] = kernel_pool
+        # runs when the worker exits after Pool.close()
+        util.Finalize(kernel_pool, kernel_pool.shutdown, exitpriority=10)
+
+
+def _run_free_test(args):
+    test, output_dir, cache, export_queue = args
+    return run_test(test, output_dir, _free_worker.get('kernel_pool'), cache, export_queue)
+
+
 #need to separate into separate functions to multiprocess
-def run_test_hw_config(id, config):
+def run_test_hw_config(id, config, warm_kernels=True, cache=None):
     tutorials, connected_hardware = load_configuration(config)
     summary = {'failed': 0, 'run': 0}
-    hw_settings = connected_hardware[id]
     output_dir = '../../tutorials/'
     nb_dir = '..'
     tests = {}
 
-    # TODO: grab HW configuration settings
-
-    for nb in tutorials.keys():
-        for test_config in tutorials[nb]['configurations']:
-            # run the test
-            if id in test_config['ids']:
-                kwargs = {
-                    'SCOPETYPE': hw_settings['scope'],
-                    'PLATFORM': hw_settings['target'],
-                    'CRYPTO_TARGET': hw_settings['firmware'],
-                    'serial_number': hw_settings.get('serial number'),
-                    'VERSION': hw_settings['tutorial type'],
-                    'SS_VER': test_config['ssver']
-
-                }
-
-                path = os.path.join(nb_dir, nb)
-                hw_kwargs = hw_settings.get('kwargs')
-                print("HW kwargs: {}".format(hw_kwargs))
-                if hw_kwargs:
-                    kwargs.update(hw_kwargs)
-
-                tutorial_kwargs = test_config.get('kwargs')
-                if tutorial_kwargs:
-                    kwargs.update(tutorial_kwargs)
-
-                print("Testing {} with {} ({})".format(nb, id, kwargs))
-                passed, output = test_notebook(nb_path=path, output_dir=output_dir, **kwargs)
-                if not passed:
-                    summary['failed'] += 1
-                summary['run'] += 1
-                header = "{} {} with config {}\n".format("Passed" if passed else "Failed", nb, id)
-                tests[header] = output
-            else:
-                pass # we don't need to test this hardware on this tutorial
+    queue = [(i,) + test for i, test in enumerate(config_tests(id, tutorials, connected_hardware, nb_dir))]
+    for index, id, passed, header, output in run_test_queue(queue, output_dir, warm_kernels, cache):
+        if not passed:
+            summary['failed'] += 1
+        summary['run'] += 1
+        tests[header] = output
 
     return summary, tests
 
-def run_tests(config):
+def run_tests(config, cpu_workers=None, warm_kernels=True, cache_dir=CACHE_DIR, export_workers=1):
+    """Runs every tutorial configuration in config.
+
+    Tests that need a board run one at a time per serial number, one
+    process per board. Hardware free (SIMULATED) tests run at the same
+    time on a pool of cpu_workers processes.
+
+    Args:
+        config (str): Path to the yaml configuration.
+        cpu_workers (int): Processes for the hardware free tests. Defaults
+            to the cores not used by the hardware queues, at least 1.
+        warm_kernels (bool): Reuse a warm kernel per process (KernelPool)
+            instead of starting one per notebook.
+        cache_dir (str): ResultCache directory, tests that passed before and
+            haven't changed since aren't run again. None runs everything.
+        export_workers (int): Processes exporting ReST/HTML (ExportStage)
+            while the tests go on. 0 exports in the test processes.
+
+    Returns:
+        tuple: (summary (dict), tests (dict))
+    """
+    import multiprocessing
+    import time
     from multiprocessing.pool import Pool
     tutorials, connected_hardware = load_configuration(config)
 
@@ -582,6 +1233,24 @@ def run_tests(config):
     # Run each on of the tutorials with each supported hardware
     # configuration for that tutorial and export the output
     # to the output directory.
+    hw_queues, free_tests = schedule_tests(tutorials, connected_hardware, nb_dir)
+    scheduled = free_tests + [test for queue in hw_queues.values() for test in queue]
+    results = []
+    cache = ResultCache(cache_dir) if cache_dir else None
+    if cache:
+        # restore unchanged tests here, only start workers for the rest
+        def cached(test):
+            return cache.has(cache.key(test[3], cache_params(**test[4])))
+        for queue in [free_tests] + list(hw_queues.values()):
+            hits = [test for test in queue if cached(test)]
+            results.extend(run_test(test, output_dir, cache=cache) for test in hits)
+            queue[:] = [test for test in queue if test not in hits]
+        hw_queues = {serial: queue for serial, queue in hw_queues.items() if queue}
+        print('{} tests unchanged since they passed'.format(len(results)))
+    if cpu_workers is None:
+        cpu_workers = max(1, multiprocessing.cpu_count() - len(hw_queues))
+    print('{} tests on {} boards, {} hardware free tests on {} processes'.format(
+        sum(len(queue) for queue in hw_queues.values()), len(hw_queues), len(free_tests), cpu_workers))
 
     # to keep track of test name and output for email
     tests = {}
@@ -591,26 +1260,80 @@ def run_tests(config):
     summary['all'] = {}
     summary['all']['failed'] = 0
     summary['all']['run'] = 0
-    results = []
-    with Pool(num_hardware) as nb_pool:
-        for i in range(num_hardware):
-            results.append(nb_pool.apply_async(run_test_hw_config, args=(i, config)))
-
-        try:
-            for index, result in enumerate(results):
-                hw_summary, hw_tests = result.get()
-                summary['all']['failed'] += hw_summary['failed']
-                summary['all']['run'] += hw_summary['run']
-                summary[str(index)] = {'failed': hw_summary['failed'], 'run': hw_summary['run']}
-                # summary[str(index)]['failed'] += hw_summary['failed']
-                # summary[str(index)]['run'] += hw_summary['run']
-                tests.update(hw_tests)
-
-                with open("config_{}_log.txt".format(index), 'w') as f:
-                    for header in hw_tests:
-                        f.write("Test {}, output:\n{}".format(header, hw_tests[header]))
-        except:
-            nb_pool.terminate()
+    for id in range(num_hardware):
+        summary[str(id)] = {'failed': 0, 'run': 0}
+    start = time.time()
+    export_stage = ExportStage(export_workers) if export_workers and (hw_queues or free_tests) else None
+    export_failures = None
+    export_queue = export_stage.queue if export_stage else None
+    # the tests the workers below run, and export if export_stage is set
+    queued = [test for queue in [free_tests] + list(hw_queues.values()) for test in queue]
+    error = None
+    hw_pool = Pool(len(hw_queues)) if hw_queues else None
+    free_pool = Pool(cpu_workers, _init_free_worker, (warm_kernels,)) if free_tests else None
+    try:
+        hw_results = [hw_pool.apply_async(run_test_queue, args=(queue, output_dir, warm_kernels, cache, export_queue))
+                      for queue in hw_queues.values()]
+        if free_pool:
+            for result in free_pool.imap_unordered(_run_free_test, [(test, output_dir, cache, export_queue) for test in free_tests]):
+                results.append(result)
+            print('Hardware free tests done in {:.0f}s'.format(time.time() - start))
+        for result in hw_results:
+            results.extend(result.get())
+        print('All tests done in {:.0f}s'.format(time.time() - start))
+        for pool in (hw_pool, free_pool):
+            if pool:
+                # close, not terminate, so the workers shut their kernels down
+                pool.close()
+                pool.join()
+        if export_stage:
+            exported, export_failures = export_stage.close()
+            print('{} notebooks exported, {} failed, done in {:.0f}s'.format(
+                exported, len(export_failures), time.time() - start))
+    except KeyboardInterrupt:
+        for pool in (hw_pool, free_pool, export_stage):
+            if pool:
+                pool.terminate()
+        raise
+    except Exception:
+        import traceback
+        error = traceback.format_exc()
+        print('Test run aborted:\n' + error)
+        for pool in (hw_pool, free_pool, export_stage):
+            if pool:
+                pool.terminate()
+
+    # every scheduled test is reported, the ones an aborted run lost as failed
+    done = {result[0] for result in results}
+    for index, id, nb, path, kwargs in scheduled:
+        if index not in done:
+            results.append((index, id, False, "Failed {} with config {}\n".format(nb, id),
+                            'No result, the test run was aborted:\n{}'.format(error)))
+    if export_stage and export_failures is None:
+        export_failures = [(test[0], 'Export unfinished, the test run was aborted:\n{}'.format(error)) for test in queued]
+
+    # a test whose export failed counts as failed: its published docs are stale
+    export_errors = dict(export_failures or [])
+    for i, (index, id, passed, header, output) in enumerate(results):
+        if index in export_errors:
+            header = "Failed" + header[len("Passed"):] if header.startswith("Passed") else header
+            results[i] = (index, id, False, header, output + '\n' + export_errors[index])
+
+    # report in configuration, then tutorials order
+    hw_tests = {id: {} for id in range(num_hardware)}
+    for index, id, passed, header, output in sorted(results, key=lambda result: result[0]):
+        if not passed:
+            summary[str(id)]['failed'] += 1
+            summary['all']['failed'] += 1
+        summary[str(id)]['run'] += 1
+        summary['all']['run'] += 1
+        hw_tests[id][header] = output
+        tests[header] = output
+
+    for id in range(num_hardware):
+        with open("config_{}_log.txt".format(id), 'w') as f:
+            for header in hw_tests[id]:
+                f.write("Test {}, output:\n{}".format(header, hw_tests[id][header]))
 
     try:
         shutil.rmtree('projects')